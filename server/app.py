@@ -1,30 +1,124 @@
 from waitress import serve
 from functools import wraps
 from secrets import token_urlsafe
-from flask import Flask, g, request, jsonify, escape, send_from_directory
+from flask import Flask, request, jsonify, escape, send_from_directory
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import jwt
 from peewee import *
 from playhouse.shortcuts import model_to_dict
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase, PooledPostgresqlDatabase
 from hashlib import sha1
 from passlib.hash import pbkdf2_sha256
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from difflib import SequenceMatcher
 import re
+import os
+import json
+import base64
+import gzip
+import smtplib
+import threading
+import multiprocessing
 import datetime
+import time
+import atexit
+import mimetypes
 import requests
 import toml
 import shortuuid
 
+# Optional: brotli variants of static assets are only built when it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Create Flask instance
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor'])
 
 # Import config
 app.config.from_file("config.toml", load=toml.load)
 app.static_url_path=app.config.get('STATIC_FOLDER')
 app.static_folder=app.root_path + app.static_url_path
 
-# Create PeeWee database instance
-database = SqliteDatabase(app.config['DATABASE'])
+# Behind TRUSTED_PROXIES reverse proxies, take the client address (which the
+# login throttle is keyed on) from the X-Forwarded-For header they set
+if app.config.get('TRUSTED_PROXIES', 0):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+# Create PeeWee database instance. Connections come from a pool shared by the
+# waitress threads. DATABASE_BACKEND selects SQLite (DATABASE is a file path)
+# or PostgreSQL (DATABASE is a database name, DATABASE_OPTIONS holds host,
+# port, user and password; requires psycopg2).
+is_sqlite = app.config.get('DATABASE_BACKEND', 'sqlite') == 'sqlite'
+
+# SQLite runs with WAL so readers carry on while a writer commits
+database_pragmas = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+    'busy_timeout': 5000,
+}
+database_pragmas.update(app.config.get('DATABASE_PRAGMAS', {}))
+
+# Routes wrapped in read_replica send their plain SELECTs to the replica when
+# one is configured. Everything else, including reads inside a transaction,
+# stays on the primary.
+read_routing = threading.local()
+
+class ReplicaRoutingMixin:
+    replica = None
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if (self.replica is not None and getattr(read_routing, 'enabled', False) and
+                not self.in_transaction() and sql.lstrip()[:6].upper() == 'SELECT'):
+            return self.replica.execute_sql(sql, *args, **kwargs)
+        return super().execute_sql(sql, *args, **kwargs)
+
+class RoutedSqliteDatabase(ReplicaRoutingMixin, PooledSqliteDatabase):
+    pass
+
+class RoutedPostgresqlDatabase(ReplicaRoutingMixin, PooledPostgresqlDatabase):
+    pass
+
+def connect_database(name, options):
+    pool = {
+        'max_connections': app.config.get('DATABASE_MAX_CONNECTIONS', 16),
+        'stale_timeout': app.config.get('DATABASE_STALE_TIMEOUT', 300),
+        'timeout': app.config.get('DATABASE_POOL_TIMEOUT', 10),
+    }
+    if is_sqlite:
+        return RoutedSqliteDatabase(name, pragmas=database_pragmas, check_same_thread=False, **pool, **options)
+    return RoutedPostgresqlDatabase(name, **pool, **options)
+
+database = connect_database(app.config['DATABASE'], app.config.get('DATABASE_OPTIONS', {}))
+if app.config.get('DATABASE_REPLICA'):
+    database.replica = connect_database(app.config['DATABASE_REPLICA'], app.config.get('DATABASE_REPLICA_OPTIONS', {}))
+
+def read_replica(fn):
+    @wraps(fn)
+    def decorator(*args, **kwargs):
+        read_routing.enabled = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            read_routing.enabled = False
+    return decorator
+
+# Write transactions take SQLite's write lock up front. Under WAL a deferred
+# transaction that reads before it writes fails with "database is locked"
+# when another writer got in first, instead of waiting for busy_timeout.
+def write_transaction():
+    if is_sqlite:
+        return database.atomic('IMMEDIATE')
+    return database.atomic()
 
 class BaseModel(Model):
     class Meta:
@@ -57,15 +151,101 @@ class Transformation(BaseModel):
     user = ForeignKeyField(User, backref='transformations', null=True)
     body = TextField()
     comment = TextField(null=True)
+    # With BODY_STORAGE = 'delta', older revisions are stored as a delta
+    # against the next revision of the same document. Heads are always full.
+    storage = CharField(default='full')
+    base = ForeignKeyField('self', null=True, index=False)
+
+    class Meta:
+        indexes = (
+            (('document', 'date'), False),
+        )
 
 class Watch(BaseModel):
     document = ForeignKeyField(Document, backref='watches')
     user = ForeignKeyField(User, backref='watches')
 
+    class Meta:
+        indexes = (
+            (('user', 'document'), True),
+            (('document', 'user'), False),
+        )
+
+class DocumentHead(BaseModel):
+    document = ForeignKeyField(Document, backref='head', unique=True)
+    transformation = ForeignKeyField(Transformation)
+    date = DateTimeField()
+    # Bumped by anything that changes the document's full response, for ETags
+    revision = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('date', 'document'), False),
+        )
+
+# Full-text index over the head body of each document, keyed by document id
+class DocumentSearch(FTS5Model):
+    rowid = RowIDField()
+    body = SearchField()
+
+    class Meta:
+        database = database
+        options = {'tokenize': 'porter unicode61'}
+
+# Trigram indexes over user and tag names for substring search and
+# autocomplete, keyed by user or tag id
+class UserSearch(FTS5Model):
+    rowid = RowIDField()
+    name = SearchField()
+
+    class Meta:
+        database = database
+        options = {'tokenize': 'trigram'}
+
+class TagSearch(FTS5Model):
+    rowid = RowIDField()
+    name = SearchField()
+
+    class Meta:
+        database = database
+        options = {'tokenize': 'trigram'}
+
 class TransformationToTagMap(BaseModel):
     transformation = ForeignKeyField(Transformation)
     tag = ForeignKeyField(Tag) 
 
+    class Meta:
+        indexes = (
+            (('tag', 'transformation'), False),
+        )
+
+# Number of documents whose head carries each tag, kept up to date by
+# set_document_head() for the tag cloud
+class TagStats(BaseModel):
+    tag = ForeignKeyField(Tag, unique=True)
+    count = IntegerField(default=0)
+
+# The tags of each document's head with the head's date, kept up to date by
+# set_document_head(), so a tag page reads its documents newest first straight
+# from the (tag, date, document) index
+class DocumentHeadTag(BaseModel):
+    tag = ForeignKeyField(Tag)
+    document = ForeignKeyField(Document)
+    date = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('tag', 'date', 'document'), False),
+            (('document', 'tag'), True),
+        )
+
+# Counters for changes that alter cached responses without moving what their
+# ETag versions are built from, such as renaming or deleting a user whose
+# name appears in listings, or replacing a deleted page
+class Generation(BaseModel):
+    name = CharField(unique=True)
+    value = IntegerField(default=0)
+
 class Log(BaseModel):
     date = DateTimeField()
     body = CharField()
@@ -74,10 +254,18 @@ class Log(BaseModel):
     affected_document = ForeignKeyField(Document, backref='logs', null=True)
     visibility=CharField()
 
+    class Meta:
+        indexes = (
+            (('visibility', 'date'), False),
+            (('initiator', 'date'), False),
+            (('affected_document', 'date'), False),
+        )
+
 class Page(BaseModel):
     slug = CharField(unique=True)
     title = TextField()
     body = TextField()
+    revision = IntegerField(default=0)
 
 class Comment(BaseModel):
     date = DateTimeField()
@@ -86,10 +274,511 @@ class Comment(BaseModel):
     user = ForeignKeyField(User, backref='comments', null=True)
     parent = ForeignKeyField('self', backref='replies', null=True)
 
+    class Meta:
+        indexes = (
+            (('document', 'parent', 'id'), False),
+        )
+
+# Something that happened to a document, recorded once however many users watch it
+class NotificationEvent(BaseModel):
+    date = DateTimeField()
+    document = ForeignKeyField(Document)
+    actor = ForeignKeyField(User, null=True)
+    kind = CharField()
+    link = CharField()
+
+# An event waiting to go out to one watcher in their next digest
+class Notification(BaseModel):
+    date = DateTimeField()
+    user = ForeignKeyField(User, backref='notifications')
+    event = ForeignKeyField(NotificationEvent)
+
+    class Meta:
+        indexes = (
+            (('user', 'date'), False),
+        )
+
+# Outbox of emails waiting to be delivered by the background worker
+class OutboundEmail(BaseModel):
+    created_date = DateTimeField()
+    to = CharField()
+    subject = CharField()
+    body = TextField()
+    attempts = IntegerField(default=0)
+    next_attempt = DateTimeField()
+    sent_date = DateTimeField(null=True)
+    last_error = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('sent_date', 'next_attempt'), False),
+        )
+
+# A user deletion run in the background by process_account_deletions(). The
+# user id is a plain column because the user row is deleted at the end.
+class AccountDeletion(BaseModel):
+    token = CharField(unique=True)
+    user_id = IntegerField()
+    username = CharField()
+    created_date = DateTimeField()
+    finished_date = DateTimeField(null=True)
+    total = IntegerField(default=0)
+    done = IntegerField(default=0)
+
+# Applied schema migrations, one row per version
+class SchemaVersion(BaseModel):
+    version = IntegerField(unique=True)
+    applied_date = DateTimeField()
+
+tables = [User, Document, Tag, Transformation, DocumentHead, Watch, TransformationToTagMap, TagStats, DocumentHeadTag, Log, Page, Comment, NotificationEvent, Notification, OutboundEmail, AccountDeletion, Generation]
+
 # simple utility function to create tables
 def create_tables():
+    # Bring older databases up to date before creating anything new
+    migrate_database()
     with database:
-        database.create_tables([User, Document, Tag, Transformation, Watch, TransformationToTagMap, Log, Page, Comment])
+        database.create_tables(tables)
+        # Full-text search relies on SQLite's FTS5
+        if is_sqlite:
+            database.create_tables([DocumentSearch, UserSearch, TagSearch])
+        # Databases created before DocumentHead and DocumentSearch existed need them filled in once
+        if not DocumentHead.select().exists() and Document.select().exists():
+            rebuild_document_heads()
+        if is_sqlite and not DocumentSearch.select().exists() and DocumentHead.select().exists():
+            rebuild_search_index()
+        if not (TagStats.select().exists() and DocumentHeadTag.select().exists()) and tag_counts_query().exists():
+            rebuild_tag_stats()
+        if is_sqlite and not UserSearch.select().exists() and User.select().exists():
+            rebuild_name_indexes()
+
+# Recompute every document's head from the full edit history. Safe to run at any
+# time to backfill or repair the DocumentHead table. Revisions start again at
+# 0, so the 'content' generation moves on to keep old ETags from matching:
+# python3 -c "from app import *; rebuild_document_heads()"
+def rebuild_document_heads():
+    Latest = Transformation.alias()
+    cte = (Latest
+            .select(Latest.document_id, fn.MAX(Latest.date).alias('max_date'))
+            .group_by(Latest.document_id)
+            .cte('latest'))
+    predicate = ((Transformation.document_id == cte.c.document_id) &
+                (Transformation.date == cte.c.max_date))
+    # Two transformations can share a date, so take the newest id among them
+    query = (Transformation
+            .select(Transformation.document_id, fn.MAX(Transformation.id), Transformation.date, SQL('0'))
+            .join(cte, on=predicate)
+            .group_by(Transformation.document_id, Transformation.date)
+            .with_cte(cte))
+    with write_transaction():
+        DocumentHead.delete().execute()
+        DocumentHead.insert_from(query, [DocumentHead.document, DocumentHead.transformation, DocumentHead.date, DocumentHead.revision]).execute()
+        bump_generation('content')
+
+# Rebuild the full-text index from the current document heads:
+# python3 -c "from app import *; rebuild_search_index()"
+def rebuild_search_index():
+    if not is_sqlite:
+        return
+    query = (DocumentHead
+            .select(DocumentHead.document_id, Transformation.body)
+            .join(Transformation))
+    with write_transaction():
+        DocumentSearch.delete().execute()
+        DocumentSearch.insert_from(query, [DocumentSearch.rowid, DocumentSearch.body]).execute()
+
+# Rebuild the user and tag name indexes:
+# python3 -c "from app import *; rebuild_name_indexes()"
+def rebuild_name_indexes():
+    if not is_sqlite:
+        return
+    with write_transaction():
+        for search_model, query in ((UserSearch, User.select(User.id, User.username)), (TagSearch, Tag.select(Tag.id, Tag.name))):
+            search_model.delete().execute()
+            search_model.insert_from(query, [search_model.rowid, search_model.name]).execute()
+
+# Count the documents per tag from the heads and their tag mappings
+def tag_counts_query():
+    return (TransformationToTagMap
+            .select(TransformationToTagMap.tag, fn.COUNT(DocumentHead.document.distinct()))
+            .join(DocumentHead, on=(DocumentHead.transformation == TransformationToTagMap.transformation))
+            .group_by(TransformationToTagMap.tag))
+
+# Recompute the per-tag document counters and DocumentHeadTag from scratch:
+# python3 -c "from app import *; rebuild_tag_stats()"
+def rebuild_tag_stats():
+    head_tags = (TransformationToTagMap
+            .select(TransformationToTagMap.tag, DocumentHead.document, DocumentHead.date)
+            .join(DocumentHead, on=(DocumentHead.transformation == TransformationToTagMap.transformation))
+            .distinct())
+    with write_transaction():
+        TagStats.delete().execute()
+        TagStats.insert_from(tag_counts_query(), [TagStats.tag, TagStats.count]).execute()
+        DocumentHeadTag.delete().execute()
+        DocumentHeadTag.insert_from(head_tags, [DocumentHeadTag.tag, DocumentHeadTag.document, DocumentHeadTag.date]).execute()
+
+# Compare the per-tag document counters with a full count and print any that
+# differ. Returns True when they all match:
+# python3 -c "from app import *; check_tag_stats()"
+def check_tag_stats():
+    with database.connection_context():
+        expected = dict(tag_counts_query().tuples())
+        stored = dict(TagStats.select(TagStats.tag, TagStats.count).where(TagStats.count != 0).tuples())
+        names = dict(Tag.select(Tag.id, Tag.name).tuples())
+    mismatched = [tag for tag in set(expected) | set(stored) if expected.get(tag, 0) != stored.get(tag, 0)]
+    for tag in sorted(mismatched, key=lambda tag: names.get(tag, '')):
+        print(f'{names.get(tag, tag)}: counted {expected.get(tag, 0)}, stored {stored.get(tag, 0)}')
+    print(f'{len(mismatched)} of {len(names)} tag counters differ.')
+    return not mismatched
+
+# Migrations
+# Schema changes for databases created by older versions, applied in order by
+# migrate_database() and recorded in SchemaVersion. Each one only touches
+# tables that already exist and skips work that is already done, because
+# create_tables() builds new tables and indexes straight from the models.
+
+# Version 1: columns for delta storage of transformation bodies
+def add_storage_columns(migrator):
+    if not Transformation.table_exists():
+        return
+    columns = [column.name for column in database.get_columns('transformation')]
+    operations = []
+    if 'storage' not in columns:
+        operations.append(migrator.add_column('transformation', 'storage', Transformation.storage))
+    if 'base_id' not in columns:
+        operations.append(migrator.add_column('transformation', 'base_id', Transformation.base))
+    migrate(*operations)
+
+# Version 2: the composite indexes declared on the models, which the hot
+# queries in get_document(), tag(), watch() and get_logs() rely on, including
+# the unique Watch(user, document) constraint
+def add_hot_path_indexes(migrator):
+    if Watch.table_exists():
+        # Drop duplicate watches so the unique index can be built
+        keep = Watch.select(fn.MIN(Watch.id)).group_by(Watch.user, Watch.document)
+        Watch.delete().where(Watch.id.not_in(keep)).execute()
+    add_model_indexes(migrator)
+
+# Create any index declared on the models that the database is missing
+def add_model_indexes(migrator):
+    operations = []
+    for model in tables:
+        if not model.table_exists():
+            continue
+        existing = [index.columns for index in database.get_indexes(model._meta.table_name)]
+        for fields, unique in model._meta.indexes:
+            columns = [model._meta.fields[field].column_name for field in fields]
+            if columns not in existing:
+                operations.append(migrator.add_index(model._meta.table_name, columns, unique))
+    migrate(*operations)
+
+# Version 3: revision counters behind the ETags of documents and pages
+def add_revision_columns(migrator):
+    operations = []
+    for model in (DocumentHead, Page):
+        if model.table_exists():
+            columns = [column.name for column in database.get_columns(model._meta.table_name)]
+            if 'revision' not in columns:
+                operations.append(migrator.add_column(model._meta.table_name, 'revision', model.revision))
+    migrate(*operations)
+
+migrations = [
+    (1, add_storage_columns),
+    (2, add_hot_path_indexes),
+    (3, add_revision_columns),
+    # Version 4: the Comment(document, parent, id) index behind GET /comment
+    (4, add_model_indexes),
+]
+
+# Apply any migrations this database hasn't had yet. create_tables() runs this
+# on start-up, or run it by hand:
+# python3 -c "from app import *; migrate_database()"
+def migrate_database():
+    with database.connection_context():
+        database.create_tables([SchemaVersion])
+        applied = set(version for version, in SchemaVersion.select(SchemaVersion.version).tuples())
+        migrator = SchemaMigrator.from_database(database)
+        for version, migration in migrations:
+            if version in applied:
+                continue
+            with write_transaction():
+                migration(migrator)
+                SchemaVersion.create(version=version, applied_date=datetime.datetime.now())
+
+# Print the query plan of each hot query on SQLite and report any that scan a
+# whole table instead of using an index, or sort their rows in a temporary
+# B-tree instead of reading them in index order. Returns True when none do:
+# python3 -c "from app import *; explain_hot_queries()"
+def explain_hot_queries():
+    queries = {
+        'document listing': (DocumentHead
+            .select(Document.uuid, Transformation.hash, Transformation.body, User.username)
+            .join(Document)
+            .join_from(DocumentHead, Transformation)
+            .join_from(Transformation, User, JOIN.LEFT_OUTER)
+            .order_by(DocumentHead.date.desc(), DocumentHead.document.desc())
+            .limit(20)),
+        'document history': (Transformation
+            .select()
+            .where(Transformation.document == 1)
+            .order_by(Transformation.date.desc())),
+        'document tags': (TransformationToTagMap
+            .select(TransformationToTagMap.transformation_id, Tag.name)
+            .join(Tag)
+            .where(TransformationToTagMap.transformation_id.in_([1, 2, 3]))),
+        'document comments': Comment.select().where(Comment.document == 1).order_by(Comment.id),
+        'comment threads': (Comment
+            .select(Comment.id)
+            .where((Comment.document == 1) & Comment.parent.is_null() & (Comment.id > 1))
+            .order_by(Comment.id)
+            .limit(20)),
+        'tag page': (DocumentHeadTag
+            .select(Document.uuid, Transformation.hash, Transformation.body, User.username)
+            .join(DocumentHead, on=(DocumentHead.document == DocumentHeadTag.document))
+            .join_from(DocumentHeadTag, Document)
+            .join_from(DocumentHead, Transformation)
+            .join_from(Transformation, User, JOIN.LEFT_OUTER)
+            .where(DocumentHeadTag.tag == 1)
+            .order_by(DocumentHeadTag.date.desc(), DocumentHeadTag.document.desc())
+            .limit(20)),
+        'watch lookup': Watch.select().where((Watch.user == 1) & (Watch.document == 1)),
+        'watchers': Watch.select(Watch.user).where((Watch.document == 1) & (Watch.user != 1)),
+        'log listing': (Log
+            .select()
+            .where(Log.visibility == 'public')
+            .order_by(Log.date.desc(), Log.id.desc())
+            .limit(20)),
+    }
+    clean = True
+    with database.connection_context():
+        for name, query in queries.items():
+            sql, params = query.sql()
+            plan = [row[-1] for row in database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+            scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+            sorts = [step for step in plan if step.startswith('USE TEMP B-TREE')]
+            clean = clean and not scans and not sorts
+            print(f"{'FULL SCAN' if scans else 'SORT' if sorts else 'ok'}: {name}")
+            for step in plan:
+                print(f'    {step}')
+    return clean
+
+# Convert an existing database to delta storage in place and report the space
+# saved. Keyframes and heads stay full; runs one document per transaction so it
+# can be interrupted and run again:
+# python3 -c "from app import *; compact_transformations()"
+def compact_transformations():
+    interval = app.config.get('BODY_KEYFRAME_INTERVAL', 20)
+    stored_before = stored_after = 0
+    size_before = os.path.getsize(database.database) if isinstance(database, SqliteDatabase) else None
+    migrate_database()
+    with database.connection_context():
+        for document in Document.select(Document.id).iterator():
+            with write_transaction():
+                rows = list(Transformation
+                        .select(Transformation.id.alias('transformation_id'), Transformation.body, Transformation.storage, Transformation.base_id.alias('base_id'))
+                        .where(Transformation.document == document.id)
+                        .order_by(Transformation.id.asc())
+                        .dicts())
+                bodies = transformation_bodies(rows)
+                for ordinal, row in enumerate(rows):
+                    stored_before += len(row['body'])
+                    if row['storage'] == 'full' and ordinal % interval and ordinal < len(rows) - 1:
+                        base = rows[ordinal + 1]['transformation_id']
+                        delta = encode_delta(bodies[base], bodies[row['transformation_id']])
+                        if len(delta) < len(row['body']):
+                            (Transformation
+                                .update(storage='delta', base=base, body=delta)
+                                .where(Transformation.id == row['transformation_id'])
+                                .execute())
+                            row['body'] = delta
+                    stored_after += len(row['body'])
+        if size_before is not None:
+            database.execute_sql('VACUUM')
+    report = { 'body_bytes_before': stored_before, 'body_bytes_after': stored_after }
+    if size_before is not None:
+        report['file_bytes_before'] = size_before
+        report['file_bytes_after'] = os.path.getsize(database.database)
+    print(json.dumps(report))
+    return report
+
+# Move log entries older than LOG_RETENTION_DAYS into gzipped NDJSON files in
+# LOG_ARCHIVE_FOLDER (relative to the server folder). Each batch is written
+# before it is deleted, so an interrupted run can only leave duplicates in the
+# archive, never lose rows:
+# python3 -c "from app import *; archive_logs()"
+def archive_logs(days=None):
+    days = days if days is not None else app.config.get('LOG_RETENTION_DAYS', 365)
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    folder = os.path.join(app.root_path, app.config.get('LOG_ARCHIVE_FOLDER', 'log-archive'))
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"log-{datetime.datetime.now():%Y%m%d%H%M%S}.ndjson.gz")
+    archived = last_id = 0
+    with database.connection_context(), gzip.open(path, 'wt', encoding='utf-8') as archive:
+        # No index leads with date, so seek on the primary key from the last
+        # batch instead of scanning from the start of the table every time
+        while True:
+            rows = list(Log.select().where((Log.id > last_id) & (Log.date < cutoff)).order_by(Log.id).limit(1000).dicts())
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            for row in rows:
+                archive.write(json.dumps(row, default=str) + '\n')
+            archive.flush()
+            with write_transaction():
+                Log.delete().where(Log.id.in_([row['id'] for row in rows])).execute()
+            archived += len(rows)
+    print(f'Archived {archived} log entries to {path}.')
+    return archived
+
+# Export the knowledge base as NDJSON, one {"table": ..., "row": ...} object
+# per line, reading each table in batches of EXPORT_BATCH_SIZE so memory use
+# stays flat. Bodies are written in full whatever the storage mode, so an
+# export can be imported with either BODY_STORAGE (run
+# compact_transformations() afterwards for delta storage). Users are included
+# with their password hashes, since everything else refers to them.
+# python3 -c "from app import *; export_data('gosshub.ndjson.gz')"
+exported_tables = [User, Document, Tag, Transformation, TransformationToTagMap, Comment, Watch, Page]
+
+def export_data(path):
+    batch_size = app.config.get('EXPORT_BATCH_SIZE', 1000)
+    started = time.monotonic()
+    counts = Counter()
+    opener = gzip.open if path.endswith('.gz') else open
+    with database.connection_context(), opener(path, 'wt', encoding='utf-8') as export:
+        export.write(json.dumps({ 'format': 'gosshub', 'version': 1, 'date': str(datetime.datetime.now()) }) + '\n')
+        for model in exported_tables:
+            last_id = 0
+            while True:
+                rows = list(model.select().where(model.id > last_id).order_by(model.id).limit(batch_size).dicts())
+                if not rows:
+                    break
+                if model is Transformation:
+                    bodies = transformation_bodies([dict(row, transformation_id=row['id'], base_id=row['base']) for row in rows])
+                    for row in rows:
+                        row.update(body=bodies[row['id']], storage='full', base=None)
+                for row in rows:
+                    export.write(json.dumps({ 'table': model._meta.table_name, 'row': row }, default=str) + '\n')
+                counts[model._meta.table_name] += len(rows)
+                last_id = rows[-1]['id']
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    print(f'Exported {total} rows in {elapsed:.1f}s ({total / max(elapsed, 0.001):.0f} rows/s): {dict(counts)}')
+    return counts
+
+# Import an export made by export_data() into an empty database, keeping every
+# id, uuid and hash. Rows are inserted with insert_many, EXPORT_BATCH_SIZE per
+# transaction, in id order, so an interrupted import can simply be run again:
+# rows up to the highest id already in each table are skipped. Document heads,
+# the search indexes and the tag counters are rebuilt at the end.
+# python3 -c "from app import *; import_data('gosshub.ndjson.gz')"
+def import_data(path):
+    batch_size = app.config.get('EXPORT_BATCH_SIZE', 1000)
+    models = { model._meta.table_name: model for model in exported_tables }
+    started = time.monotonic()
+    counts = Counter()
+    create_tables()
+    opener = gzip.open if path.endswith('.gz') else open
+    with database.connection_context(), opener(path, 'rt', encoding='utf-8') as export:
+        done = { name: model.select(fn.MAX(model.id)).scalar() or 0 for name, model in models.items() }
+        pending = {}
+        def flush(name):
+            model = models[name]
+            with write_transaction():
+                for rows in chunked(pending.pop(name), 100):
+                    model.insert_many(rows).execute()
+        for line in export:
+            entry = json.loads(line)
+            if 'table' not in entry:
+                continue
+            name, row = entry['table'], entry['row']
+            if row['id'] <= done[name]:
+                continue
+            for field_name, value in row.items():
+                if isinstance(models[name]._meta.fields[field_name], DateTimeField) and isinstance(value, str):
+                    row[field_name] = datetime.datetime.fromisoformat(value)
+            # Tables come one after another, so a new table ends the last batch
+            for other in [other for other in pending if other != name]:
+                flush(other)
+            pending.setdefault(name, []).append(row)
+            counts[name] += 1
+            if len(pending[name]) >= batch_size:
+                flush(name)
+        for name in list(pending):
+            flush(name)
+        if not is_sqlite:
+            # Explicit ids leave the sequences behind
+            for name, model in models.items():
+                database.execute_sql(f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), COALESCE(MAX(id), 1)) FROM \"{name}\"")
+        rebuild_document_heads()
+        rebuild_search_index()
+        rebuild_tag_stats()
+        rebuild_name_indexes()
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    print(f'Imported {total} rows in {elapsed:.1f}s ({total / max(elapsed, 0.001):.0f} rows/s): {dict(counts)}')
+    return counts
+
+# Static assets
+# build_static_assets() writes a content-hashed copy of every file in
+# frontend/dist (bundle.js becomes bundle.<hash>.js) with precompressed .gz
+# and, if the brotli module is installed, .br variants next to it, and lists
+# them in manifest.json. Run it after every frontend build:
+# python3 -c "from app import *; build_static_assets()"
+static_dist = os.path.join(app.static_folder, 'dist')
+static_manifest_path = os.path.join(static_dist, 'manifest.json')
+static_compressible = ('.js', '.css', '.html', '.txt', '.svg', '.json', '.ttf')
+static_suffixes = { 'br': 'br', 'gzip': 'gz' }
+static_link = re.compile(r'/cdn/([^)"\'\s?#]+)')
+
+def load_static_manifest():
+    try:
+        with open(static_manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def rewrite_asset_links(text, manifest):
+    return static_link.sub(lambda match: '/cdn/' + manifest.get(match.group(1), {}).get('path', match.group(1)), text)
+
+def build_static_assets():
+    previous = load_static_manifest()
+    for entry in previous.values():
+        for suffix in [''] + ['.' + static_suffixes[encoding] for encoding in entry['encodings']]:
+            if os.path.exists(os.path.join(static_dist, entry['path'] + suffix)):
+                os.remove(os.path.join(static_dist, entry['path'] + suffix))
+    sources = []
+    for root, dirs, files in os.walk(static_dist):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_dist).replace(os.sep, '/')
+            if path not in ('index.html', 'manifest.json') and not path.endswith(('.gz', '.br')):
+                sources.append(path)
+    # Stylesheets go last so their url()s can point at the hashed fonts
+    manifest = {}
+    bytes_before = bytes_after = 0
+    for path in sorted(sources, key=lambda path: (path.endswith('.css'), path)):
+        with open(os.path.join(static_dist, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_asset_links(content.decode('utf-8'), manifest).encode('utf-8')
+        root, extension = os.path.splitext(path)
+        hashed = f'{root}.{sha1(content).hexdigest()[:12]}{extension}'
+        variants = {}
+        if extension in static_compressible:
+            if brotli is not None:
+                variants['br'] = brotli.compress(content, quality=11)
+            variants['gzip'] = gzip.compress(content, 9)
+        encodings = [encoding for encoding, data in variants.items() if len(data) < len(content)]
+        with open(os.path.join(static_dist, hashed), 'wb') as f:
+            f.write(content)
+        for encoding in encodings:
+            with open(os.path.join(static_dist, hashed + '.' + static_suffixes[encoding]), 'wb') as f:
+                f.write(variants[encoding])
+        manifest[path] = { 'path': hashed, 'encodings': encodings }
+        bytes_before += len(content)
+        bytes_after += min([len(content)] + [len(variants[encoding]) for encoding in encodings])
+    with open(static_manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f'Built {len(manifest)} static assets, {bytes_before} bytes ({bytes_after} bytes compressed).')
+    return manifest
 
 # Success handler
 def success(message="Success", status=200):
@@ -116,17 +805,34 @@ class APIErrorUnauthorized(Exception):
     status = 401
     description = 'Unauthorized'
 
+class APIErrorTooManyRequests(Exception):
+    status = 429
+    description = 'Too Many Requests'
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class APIErrorServiceUnavailable(Exception):
+    status = 503
+    description = 'Service Unavailable'
+
 @app.errorhandler(APIErrorBadRequest)
 @app.errorhandler(APIErrorConflict)
 @app.errorhandler(APIErrorNotFound)
 @app.errorhandler(APIErrorUnauthorized)
+@app.errorhandler(APIErrorTooManyRequests)
+@app.errorhandler(APIErrorServiceUnavailable)
 def handle_exception(err):
     response = {
         "error": err.description,
         "status": err.status,
         "message": str(err)
     }
-    return jsonify(response), err.status
+    headers = {}
+    if getattr(err, 'retry_after', None):
+        headers['Retry-After'] = str(err.retry_after)
+    return jsonify(response), err.status, headers
 
 # Utility functions
 
@@ -149,18 +855,575 @@ def transformation_hash(date, body):
     h = sha1(str(int(date.timestamp())).encode('utf-8') + body.encode('utf-8'))
     return h.hexdigest()
 
-@database.func()
 def json_field(field):
     return jsonify(field)
 
+if is_sqlite:
+    database.register_function(json_field)
+
+# Collects log entries in memory and writes them with one insert_many when
+# LOG_BUFFER_SIZE entries are waiting or LOG_FLUSH_INTERVAL seconds have
+# passed, from its own thread so request transactions never include them
+class LogBuffer:
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.failures = 0
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='log-buffer', daemon=True)
+                self.thread.start()
+            if len(self.entries) >= app.config.get('LOG_BUFFER_SIZE', 100):
+                self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(app.config.get('LOG_FLUSH_INTERVAL', 1))
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Flushing the log buffer failed')
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                entries, self.entries = self.entries, []
+            if not entries:
+                return
+            start = time.monotonic()
+            opened = database.is_closed()
+            if opened:
+                database.connect()
+            try:
+                written = self.write(entries)
+            finally:
+                if opened:
+                    database.close()
+            with metrics_lock:
+                metrics['log_flushes'] += 1
+                metrics['log_entries_flushed'] += written
+                metrics['log_flush_latency_ms'] = round((time.monotonic() - start) * 1000, 3)
+
+    # A failed batch goes back in the buffer for the next flush. After
+    # LOG_FLUSH_ATTEMPTS failures in a row the entries are written one at a
+    # time, so a single bad entry only loses itself.
+    def write(self, entries):
+        try:
+            with write_transaction():
+                release_deleted_users(entries)
+                Log.insert_many(entries).execute()
+            self.failures = 0
+            return len(entries)
+        except Exception:
+            self.failures += 1
+            if self.failures < app.config.get('LOG_FLUSH_ATTEMPTS', 5):
+                with self.lock:
+                    self.entries[:0] = entries
+                raise
+        self.failures = 0
+        written = 0
+        for entry in entries:
+            try:
+                with write_transaction():
+                    release_deleted_users([entry])
+                    Log.insert(entry).execute()
+                written += 1
+            except Exception:
+                app.logger.exception(f"Dropping log entry {entry['body']!r}")
+                count_metric('log_entries_dropped')
+        return written
+
+# Buffered entries can name a user deleted since they were logged; clear
+# those references rather than insert ids that no longer exist
+def release_deleted_users(entries):
+    user_ids = { getattr(entry[key], 'id', entry[key]) for entry in entries for key in ('initiator', 'affected_user') } - { None }
+    if not user_ids:
+        return
+    existing = { user_id for user_id, in User.select(User.id).where(User.id.in_(list(user_ids))).tuples() }
+    for entry in entries:
+        for key in ('initiator', 'affected_user'):
+            if entry[key] is not None and getattr(entry[key], 'id', entry[key]) not in existing:
+                entry[key] = None
+
+log_buffer = LogBuffer()
+atexit.register(log_buffer.flush)
+
+# Entries are buffered unless LOG_BUFFER is false, in which case they are
+# written straight away (useful in tests)
 def log(body='', initiator=None, affected_user=None, affected_document=None, visibility='admin'):
-    log = Log.create(
-        date=datetime.datetime.now(),
-        body=body,
-        initiator=initiator,
-        affected_user=affected_user,
-        affected_document=affected_document,
-        visibility=visibility)
+    entry = {
+        'date': datetime.datetime.now(),
+        'body': body,
+        'initiator': initiator,
+        'affected_user': affected_user,
+        'affected_document': affected_document,
+        'visibility': visibility,
+    }
+    if app.config.get('LOG_BUFFER', True):
+        log_buffer.add(entry)
+    else:
+        Log.create(**entry)
+
+# Point a document at its newest transformation and reindex its body. Call
+# this inside the same transaction that creates the transformation.
+def set_document_head(document, transformation):
+    # Move the tag counters from the old head's tags to the new one's
+    previous = DocumentHead.select(DocumentHead.transformation).where(DocumentHead.document == document).scalar()
+    mappings = (TransformationToTagMap
+            .select(TransformationToTagMap.transformation, TransformationToTagMap.tag)
+            .where(TransformationToTagMap.transformation.in_([tid for tid in (previous, transformation.id) if tid]))
+            .tuples())
+    old_tags = set(tag for tid, tag in mappings if tid == previous)
+    new_tags = set(tag for tid, tag in mappings if tid == transformation.id)
+    if old_tags - new_tags:
+        TagStats.update(count=TagStats.count - 1).where(TagStats.tag.in_(list(old_tags - new_tags))).execute()
+    if new_tags - old_tags:
+        (TagStats
+            .insert_many([{ 'tag': tag, 'count': 1 } for tag in new_tags - old_tags])
+            .on_conflict(conflict_target=[TagStats.tag], update={ TagStats.count: TagStats.count + 1 })
+            .execute())
+    DocumentHeadTag.delete().where(DocumentHeadTag.document == document).execute()
+    if new_tags:
+        DocumentHeadTag.insert_many([{ 'tag': tag, 'document': document, 'date': transformation.date } for tag in new_tags]).execute()
+    (DocumentHead
+        .insert(document=document, transformation=transformation, date=transformation.date)
+        .on_conflict(
+            conflict_target=[DocumentHead.document],
+            preserve=[DocumentHead.transformation, DocumentHead.date],
+            update={ DocumentHead.revision: DocumentHead.revision + 1 })
+        .execute())
+    if is_sqlite:
+        (DocumentSearch
+            .insert({ DocumentSearch.rowid: document.id, DocumentSearch.body: transformation.body })
+            .on_conflict_replace()
+            .execute())
+
+# Comments and watches change a document's response without a new head
+def touch_document(document):
+    DocumentHead.update(revision=DocumentHead.revision + 1).where(DocumentHead.document == document).execute()
+
+# Add or replace entries of UserSearch or TagSearch from a dict of id -> name
+def index_names(search_model, names):
+    if is_sqlite and names:
+        (search_model
+            .insert_many([{ search_model.rowid: id, search_model.name: name } for id, name in names.items()])
+            .on_conflict_replace()
+            .execute())
+
+def unindex_name(search_model, id):
+    if is_sqlite:
+        search_model.delete().where(search_model.rowid == id).execute()
+
+# Filter for names containing text. Three characters or more go through the
+# trigram index on SQLite; shorter text, which trigrams can't match, becomes a
+# prefix range scan over the unique name index.
+def name_matches(field, search_model, text):
+    if len(text) < 3:
+        return (field >= text) & (field < text + '\uffff')
+    if not is_sqlite:
+        return field.contains(text)
+    phrase = '"' + text.replace('"', '""') + '"'
+    return field.model.id.in_(search_model.select(search_model.rowid).where(search_model.match(phrase)))
+
+# Turn free text into an FTS5 query matching every word, without letting
+# users inject FTS5 syntax
+def search_expression(text):
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', text))
+
+# Serialization
+# Control characters marking matches in search snippets
+snippet_start, snippet_end = '\x02', '\x03'
+
+# Fetch the tag names of a batch of transformations in a single query,
+# returned as a dict of transformation id -> list of tag names.
+def tags_for_transformations(transformation_ids):
+    tags = { transformation_id: [] for transformation_id in transformation_ids }
+    if not tags:
+        return tags
+    query = (TransformationToTagMap
+            .select(TransformationToTagMap.transformation_id, Tag.name)
+            .join(Tag)
+            .where(TransformationToTagMap.transformation_id.in_(list(tags)))
+            .order_by(TransformationToTagMap.id)
+            .tuples())
+    for transformation_id, name in query:
+        tags[transformation_id].append(name)
+    return tags
+
+# Rows must carry transformation_id, hash, username, body and date columns
+def serialize_transformations(rows, with_bodies=True):
+    rows = list(rows)
+    tags = tags_for_transformations([row['transformation_id'] for row in rows])
+    bodies = transformation_bodies(rows) if with_bodies else {}
+    transformations = []
+    for row in rows:
+        transformation = {
+            'username': row['username'],
+            'hash': row['hash'],
+            'date': row['date'],
+            'tags': tags[row['transformation_id']]
+        }
+        if with_bodies:
+            transformation['body'] = bodies[row['transformation_id']]
+        # Search results carry a highlighted excerpt of the matching body. The
+        # excerpt is escaped before its match markers become <mark> tags, so it
+        # can be shown as HTML.
+        if 'snippet' in row:
+            transformation['snippet'] = str(escape(row['snippet'])).replace(snippet_start, '<mark>').replace(snippet_end, '</mark>')
+        transformations.append(transformation)
+    return transformations
+
+# Documents in listings only carry their most recent transformation
+def serialize_documents(rows):
+    rows = list(rows)
+    transformations = serialize_transformations(rows)
+    return [{
+        'uuid': row['uuid'],
+        'transformations': [transformation]
+    } for row, transformation in zip(rows, transformations)]
+
+# Metrics
+# In-process counters, reported by GET /metrics
+metrics = Counter()
+metrics_lock = threading.Lock()
+
+def count_metric(name, amount=1):
+    with metrics_lock:
+        metrics[name] += amount
+
+# Caching
+# Small thread-safe LRU cache for the in-process caches below. Entries expire
+# after ttl seconds when one is given.
+class LRUCache:
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or (item[0] is not None and item[0] < time.monotonic()):
+                self.items.pop(key, None)
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl if self.ttl else None, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def delete_matching(self, predicate):
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                del self.items[key]
+
+    def stats(self):
+        with self.lock:
+            return { 'size': len(self.items), 'hits': self.hits, 'misses': self.misses }
+
+# Revision storage
+# Reconstructed bodies of delta-stored revisions, keyed by transformation id
+body_cache = LRUCache(app.config.get('BODY_CACHE_SIZE', 1000))
+
+# A delta is a JSON list of [start, end] line ranges copied from the base body
+# and literal strings inserted between them
+def encode_delta(base, body):
+    base_lines = base.splitlines(keepends=True)
+    body_lines = body.splitlines(keepends=True)
+    delta = []
+    for op, i1, i2, j1, j2 in SequenceMatcher(None, base_lines, body_lines).get_opcodes():
+        if op == 'equal':
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append(''.join(body_lines[j1:j2]))
+    return json.dumps(delta, separators=(',', ':'))
+
+def apply_delta(base, delta):
+    base_lines = base.splitlines(keepends=True)
+    return ''.join(''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in json.loads(delta))
+
+# Return a dict of transformation id -> full body for rows carrying
+# transformation_id and body columns. Rows without storage columns (such as
+# heads, which are never deltas) are taken as they are; delta bases missing
+# from the rows are fetched as needed.
+def transformation_bodies(rows):
+    stored = { row['transformation_id']: row for row in rows }
+    bodies = {}
+    def resolve(transformation_id):
+        if transformation_id in bodies:
+            return bodies[transformation_id]
+        row = stored.get(transformation_id)
+        if row is None:
+            row = (Transformation
+                    .select(Transformation.id.alias('transformation_id'), Transformation.body, Transformation.storage, Transformation.base_id.alias('base_id'))
+                    .where(Transformation.id == transformation_id)
+                    .dicts()
+                    .get())
+        if row.get('storage') == 'delta':
+            body = body_cache.get(transformation_id)
+            if body is None:
+                body = apply_delta(resolve(row['base_id']), row['body'])
+                body_cache.set(transformation_id, body)
+        else:
+            body = row['body']
+        bodies[transformation_id] = body
+        return body
+    for transformation_id in stored:
+        resolve(transformation_id)
+    return bodies
+
+# In delta mode, a head that is replaced gets stored as a delta against its
+# successor, unless it falls on a keyframe (every BODY_KEYFRAME_INTERVAL-th
+# revision of the document), which stays full so chains stay short
+def store_previous_revision(previous, transformation):
+    if app.config.get('BODY_STORAGE', 'full') != 'delta':
+        return
+    ordinal = (Transformation
+            .select()
+            .where((Transformation.document == previous.document_id) & (Transformation.id < previous.id))
+            .count())
+    if not ordinal % app.config.get('BODY_KEYFRAME_INTERVAL', 20):
+        return
+    delta = encode_delta(transformation.body, previous.body)
+    if len(delta) < len(previous.body):
+        (Transformation
+            .update(storage='delta', base=transformation, body=delta)
+            .where(Transformation.id == previous.id)
+            .execute())
+
+# Diffs
+# Bodies never change once written, so a diff between two hashes is cached for
+# good (up to DIFF_CACHE_SIZE entries). Hunks hold 0-based line offsets into
+# each body and a list of ['=', text], ['-', text] and ['+', text] changes.
+# Word diffs only compare the words of lines the line diff found changed, so
+# they cost about the same as line diffs on long documents.
+diff_cache = LRUCache(app.config.get('DIFF_CACHE_SIZE', 200))
+diff_granularities = ('line', 'word')
+
+def diff_changes(before, after, autojunk=True):
+    changes = []
+    for op, i1, i2, j1, j2 in SequenceMatcher(None, before, after, autojunk=autojunk).get_opcodes():
+        if op == 'equal':
+            changes.append(['=', ''.join(before[i1:i2])])
+            continue
+        if i2 > i1:
+            changes.append(['-', ''.join(before[i1:i2])])
+        if j2 > j1:
+            changes.append(['+', ''.join(after[j1:j2])])
+    return changes
+
+def diff_hunks(before, after, granularity, context):
+    before = before.splitlines(keepends=True)
+    after = after.splitlines(keepends=True)
+    hunks = []
+    for group in SequenceMatcher(None, before, after).get_grouped_opcodes(context):
+        if all(op == 'equal' for op, i1, i2, j1, j2 in group):
+            continue
+        changes = []
+        for op, i1, i2, j1, j2 in group:
+            if op == 'replace' and granularity == 'word':
+                # Whitespace is a token of its own, so a changed line break
+                # doesn't take the words next to it along. Comparing tokens
+                # grows quadratically without autojunk, which skips spaces as
+                # the commonest token, so it is only off for small blocks, and
+                # rewrites of whole sections are shown line by line.
+                old_words = re.findall(r'\s+|\S+', ''.join(before[i1:i2]))
+                new_words = re.findall(r'\s+|\S+', ''.join(after[j1:j2]))
+                size = len(old_words) + len(new_words)
+                if size <= 10000:
+                    changes += diff_changes(old_words, new_words, autojunk=size > 1000)
+                    continue
+            changes += diff_changes(before[i1:i2], after[j1:j2])
+        merged = []
+        for change in changes:
+            if merged and merged[-1][0] == change[0]:
+                merged[-1][1] += change[1]
+            else:
+                merged.append(change)
+        hunks.append({
+            'from_start': group[0][1],
+            'from_count': group[-1][2] - group[0][1],
+            'to_start': group[0][3],
+            'to_count': group[-1][4] - group[0][3],
+            'changes': merged,
+        })
+    return hunks
+
+# Response caching
+# GET routes wrapped in cached_response get a strong ETag built from a cheap
+# version query, answer If-None-Match with a 304 without running the route,
+# and keep their last response per URL in response_cache. Writes call
+# invalidate_responses() for the routes they affect.
+response_cache = LRUCache(app.config.get('RESPONSE_CACHE_SIZE', 500))
+cached_headers = ['X-Next-Cursor']
+
+def invalidate_responses(*endpoints):
+    response_cache.delete_matching(lambda key: key[0] in endpoints)
+
+def generation(name):
+    return fn.COALESCE(Generation.select(Generation.value).where(Generation.name == name), 0)
+
+def bump_generation(name):
+    (Generation
+        .insert(name=name, value=1)
+        .on_conflict(conflict_target=[Generation.name], update={ Generation.value: Generation.value + 1 })
+        .execute())
+
+# Any change to any document moves its head date forward, so the newest head
+# date versions every listing built from DocumentHead. Usernames in them
+# change with the 'content' generation.
+def heads_version():
+    return DocumentHead.select(fn.MAX(DocumentHead.date), generation('content')).tuples().first()
+
+def document_version():
+    if not request.args or 'uuid' not in request.args:
+        return heads_version()
+    head = (DocumentHead
+            .select(Transformation.hash, DocumentHead.revision, generation('content'))
+            .join(Document)
+            .join_from(DocumentHead, Transformation)
+            .where(Document.uuid == request.args['uuid'])
+            .tuples()
+            .first())
+    # Unknown documents fall through to the route's 404
+    return head and f'{head[0]}-{head[1]}-{head[2]}'
+
+# Every page write bumps the 'pages' generation, so a page deleted and created
+# again under the same slug doesn't get its old ETag back
+def page_version():
+    return Generation.select(fn.COALESCE(fn.MAX(Generation.value), 0)).where(Generation.name == 'pages').scalar()
+
+def cached_response(version_function):
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            version = version_function()
+            if version is None:
+                return fn(*args, **kwargs)
+            etag = sha1(f'{request.full_path}|{version}'.encode('utf-8')).hexdigest()
+            key = (fn.__name__, request.full_path)
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                cached = response_cache.get(key)
+                if cached and cached[0] == etag:
+                    response = app.response_class(cached[1], mimetype='application/json', headers=cached[2])
+                else:
+                    response = app.make_response(fn(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    headers = { name: response.headers[name] for name in cached_headers if name in response.headers }
+                    response_cache.set(key, (etag, response.get_data(), headers))
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = app.config.get('CACHE_CONTROL', {}).get(fn.__name__, 'no-cache')
+            return response
+        return decorator
+    return wrapper
+
+# Pagination
+# Listings accept either the old page= parameter or an opaque cursor= token
+# taken from the X-Next-Cursor header of the previous page, plus limit=.
+def page_size():
+    try:
+        limit = int(request.args.get('limit', app.config.get('PAGE_SIZE', 20)))
+    except ValueError:
+        raise APIErrorBadRequest('Limit must be a number.')
+    return max(1, min(limit, app.config.get('PAGE_SIZE_MAX', 100)))
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise APIErrorBadRequest('Invalid cursor.')
+
+def page_number():
+    try:
+        return max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        raise APIErrorBadRequest('Page must be a number.')
+
+# Page through a query newest first, keyed on (date, id) so deep pages cost
+# the same as the first one. Returns the rows as dicts and the cursor of the
+# next page, or None on the last page.
+def paginate_by_date(query, date_field, id_field):
+    limit = page_size()
+    query = (query
+            .select_extend(date_field.alias('cursor_date'), id_field.alias('cursor_id'))
+            .order_by(date_field.desc(), id_field.desc()))
+    if 'cursor' in request.args:
+        position = decode_cursor(request.args['cursor'])
+        try:
+            date = datetime.datetime.fromisoformat(position['date'])
+            cursor_id = int(position['id'])
+        except (KeyError, TypeError, ValueError):
+            raise APIErrorBadRequest('Invalid cursor.')
+        query = (query
+                .where((date_field < date) | ((date_field == date) & (id_field < cursor_id)))
+                .limit(limit))
+    else:
+        query = query.paginate(page_number(), limit)
+    rows = list(query.dicts())
+    cursor = None
+    if len(rows) == limit:
+        cursor = encode_cursor({ 'date': rows[-1]['cursor_date'].isoformat(), 'id': rows[-1]['cursor_id'] })
+    for row in rows:
+        del row['cursor_date'], row['cursor_id']
+    return rows, cursor
+
+def suggest_limit():
+    try:
+        limit = int(request.args.get('limit', app.config.get('SUGGEST_LIMIT', 10)))
+    except ValueError:
+        raise APIErrorBadRequest('Limit must be a number.')
+    return max(1, min(limit, app.config.get('PAGE_SIZE_MAX', 100)))
+
+# Ranked results have no stable key to seek from, so their cursor holds an offset
+def paginate_ranked(query):
+    limit = page_size()
+    if 'cursor' in request.args:
+        try:
+            offset = int(decode_cursor(request.args['cursor'])['offset'])
+        except (KeyError, TypeError, ValueError):
+            raise APIErrorBadRequest('Invalid cursor.')
+    else:
+        offset = (page_number() - 1) * limit
+    rows = list(query.offset(offset).limit(limit).dicts())
+    if len(rows) < limit:
+        return rows, None
+    return rows, encode_cursor({ 'offset': offset + limit })
+
+def paginated(items, cursor):
+    response = jsonify(items)
+    if cursor:
+        response.headers['X-Next-Cursor'] = cursor
+    return response
 
 # Validation
 def validate(dictionary, field, minlength=False, maxlength=False, match=False, regex=False):
@@ -186,15 +1449,399 @@ def sanitize(dictionary):
     return { k: v.strip() if type(v) is str else v for k, v in dictionary.items()}
 
 # Email
+# Handlers only queue emails; deliver_outbox() sends them from the background worker
 def send_email(to, subject, body):
-    return requests.post(
+    now = datetime.datetime.now()
+    return OutboundEmail.create(
+        created_date=now,
+        to=to,
+        subject=subject,
+        body=body,
+        next_attempt=now)
+
+EMAIL_SENDER = "GossHub <mail@gosshub.com>"
+
+class EmailTransport:
+    # Returns one exception (or None on success) per email
+    def send_batch(self, emails):
+        errors = []
+        for email in emails:
+            try:
+                self.send(email)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+class MailgunTransport(EmailTransport):
+    def __init__(self):
+        # One pooled session keeps connections to Mailgun alive between emails
+        self.session = requests.Session()
+        self.session.auth = ("api", app.config['MAILGUN_KEY'])
+
+    def send(self, email):
+        response = self.session.post(
             "https://api.eu.mailgun.net/v3/mail.gosshub.com/messages",
-            auth=("api", app.config['MAILGUN_KEY']),
             data={
-                "from": "GossHub <mail@gosshub.com>",
-                "to": to,
-                "subject": subject,
-                "text": body})
+                "from": EMAIL_SENDER,
+                "to": email.to,
+                "subject": email.subject,
+                "text": email.body},
+            timeout=30)
+        response.raise_for_status()
+
+class SMTPTransport(EmailTransport):
+    def send_batch(self, emails):
+        # Deliver the whole batch over a single SMTP connection
+        try:
+            self.connection = smtplib.SMTP(app.config.get('SMTP_HOST', 'localhost'), app.config.get('SMTP_PORT', 25), timeout=30)
+        except Exception as e:
+            return [e for email in emails]
+        try:
+            return super().send_batch(emails)
+        finally:
+            self.connection.quit()
+
+    def send(self, email):
+        self.connection.sendmail(EMAIL_SENDER, [email.to], (
+            f"From: {EMAIL_SENDER}\r\n"
+            f"To: {email.to}\r\n"
+            f"Subject: {email.subject}\r\n\r\n" +
+            email.body).encode('utf-8'))
+
+# Appends emails to a local NDJSON file instead of sending them, for
+# development and tests
+class FileTransport(EmailTransport):
+    def send(self, email):
+        with open(app.config.get('EMAIL_FILE', 'outbox.ndjson'), 'a') as f:
+            f.write(json.dumps({ 'to': email.to, 'subject': email.subject, 'body': email.body }) + '\n')
+
+email_transports = {
+    'mailgun': MailgunTransport,
+    'smtp': SMTPTransport,
+    'file': FileTransport,
+}
+email_transport = None
+
+# Send a batch of due emails. Failures are retried with exponential backoff
+# until EMAIL_MAX_ATTEMPTS is reached, after which they stay in the outbox
+# with their last error.
+def deliver_outbox():
+    global email_transport
+    if email_transport is None:
+        email_transport = email_transports[app.config.get('EMAIL_TRANSPORT', 'mailgun')]()
+    now = datetime.datetime.now()
+    emails = list(OutboundEmail
+            .select()
+            .where(OutboundEmail.sent_date.is_null() &
+                (OutboundEmail.next_attempt <= now) &
+                (OutboundEmail.attempts < app.config.get('EMAIL_MAX_ATTEMPTS', 5)))
+            .order_by(OutboundEmail.next_attempt)
+            .limit(app.config.get('EMAIL_BATCH_SIZE', 50)))
+    if not emails:
+        return 0
+    errors = email_transport.send_batch(emails)
+    delivered = [email.id for email, error in zip(emails, errors) if error is None]
+    with write_transaction():
+        if delivered:
+            OutboundEmail.update(sent_date=now).where(OutboundEmail.id.in_(delivered)).execute()
+        for email, error in zip(emails, errors):
+            if error is not None:
+                email.attempts += 1
+                email.last_error = str(error)
+                email.next_attempt = now + datetime.timedelta(seconds=app.config.get('EMAIL_RETRY_DELAY', 60) * 2 ** (email.attempts - 1))
+                email.save()
+    return len(delivered)
+
+# Notifications
+# Queue an event for everyone watching the document except the user who caused it
+def notify(document, actor, kind, link):
+    now = datetime.datetime.now()
+    event = NotificationEvent.create(
+        date=now,
+        document=document,
+        actor=actor,
+        kind=kind,
+        link=link)
+    watchers = (Watch
+            .select(Watch.user)
+            .where((Watch.document == document) & (Watch.user != actor))
+            .tuples())
+    queued = [{ 'user': user_id, 'date': now, 'event': event } for user_id, in watchers]
+    if queued:
+        Notification.insert_many(queued).execute()
+    count_metric('notification_events')
+    count_metric('notifications_queued', len(queued))
+
+# Single events keep the wording of the emails sent before digests existed
+notification_templates = {
+    'edit': ('Document updated on GossHub', "A document you're watching has been updated by {actor}. Follow this link to see the update:\n{link}\n\n"),
+    'comment': ('New comment on GossHub', "The user {actor} has commented on a document you're following on GossHub. Follow this link to see the update:\n{link}\n\n"),
+}
+digest_lines = {
+    'edit': "- {actor} updated a document: {link}\n",
+    'comment': "- {actor} commented on a document: {link}\n",
+}
+
+# Send each user with pending notifications one email covering all of them,
+# once NOTIFICATION_DIGEST_WINDOW seconds have passed since the oldest one
+def deliver_notifications():
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=app.config.get('NOTIFICATION_DIGEST_WINDOW', 300))
+    due_users = (Notification
+            .select(Notification.user)
+            .group_by(Notification.user)
+            .having(fn.MIN(Notification.date) <= cutoff))
+    Actor = User.alias()
+    query = (Notification
+            .select(Notification.id, Notification.user_id.alias('user_id'), User.email, NotificationEvent.kind, NotificationEvent.link, Actor.username.alias('actor'))
+            .join(User)
+            .join_from(Notification, NotificationEvent)
+            .join(Actor, JOIN.LEFT_OUTER, on=(NotificationEvent.actor == Actor.id))
+            .where(Notification.user.in_(due_users))
+            .order_by(Notification.user, Notification.id)
+            .dicts())
+    digests = OrderedDict()
+    for row in query:
+        row['actor'] = row['actor'] or 'a deleted user'
+        digests.setdefault(row['user_id'], []).append(row)
+    if not digests:
+        return 0
+    with write_transaction():
+        for rows in digests.values():
+            if len(rows) == 1:
+                subject, template = notification_templates[rows[0]['kind']]
+                body = "Hi!\n\n" + template.format(**rows[0])
+            else:
+                subject = 'Activity on documents you\'re watching on GossHub'
+                body = ("Hi!\n\n" +
+                    "There has been activity on documents you're watching on GossHub:\n\n" +
+                    ''.join(digest_lines[row['kind']].format(**row) for row in rows) + "\n")
+            send_email(to=rows[0]['email'], subject=subject, body=body + "Best,\n\n" + "GossHub")
+            count_metric('notifications_coalesced', len(rows) - 1)
+        delivered = [row['id'] for rows in digests.values() for row in rows]
+        Notification.delete().where(Notification.id.in_(delivered)).execute()
+        NotificationEvent.delete().where(NotificationEvent.id.not_in(Notification.select(Notification.event))).execute()
+    count_metric('notifications_delivered', len(delivered))
+    count_metric('notification_digests_sent', len(digests))
+    return len(digests)
+
+# Background worker
+# Account deletion
+# Columns that point at a user, which are cleared when the user is deleted,
+# and rows that are deleted along with the user. Usernames and watches show up
+# in document responses, so the documents of affected rows get a new revision
+# and listings a new 'content' generation.
+user_references = [Transformation.user, Comment.user, Tag.creator, Log.initiator, Log.affected_user, NotificationEvent.actor]
+user_rows = [Watch.user, Notification.user]
+document_models = (Transformation, Comment, Watch)
+
+def count_user_rows(user_id):
+    return sum(field.model.select().where(field == user_id).count() for field in user_references + user_rows)
+
+# Clear (or delete) up to limit rows pointing at the user through field, or
+# all of them without a limit. Returns the number of rows changed.
+def release_user_rows(field, user_id, limit=None):
+    model = field.model
+    rows = model.select(model.id).where(field == user_id).limit(limit)
+    if model in document_models:
+        (DocumentHead
+            .update(revision=DocumentHead.revision + 1)
+            .where(DocumentHead.document.in_(model.select(model.document).where(model.id.in_(rows))))
+            .execute())
+        bump_generation('content')
+    # Fields compare with == into an expression, so match them by identity
+    if any(field is row for row in user_rows):
+        return model.delete().where(model.id.in_(rows)).execute()
+    return model.update({ field: None }).where(model.id.in_(rows)).execute()
+
+# Whether the user is queued for a background deletion that hasn't finished
+def deletion_pending(user_id):
+    return (AccountDeletion.select()
+            .where((AccountDeletion.user_id == user_id) & AccountDeletion.finished_date.is_null())
+            .exists())
+
+# Delete a user with one statement per table, in a single transaction
+def delete_user(user_id):
+    with write_transaction():
+        for field in user_references + user_rows:
+            release_user_rows(field, user_id)
+        User.delete().where(User.id == user_id).execute()
+        unindex_name(UserSearch, user_id)
+
+# Work through queued account deletions in batches of USER_DELETE_BATCH_SIZE
+# rows, one transaction each, recording progress as it goes. An interrupted
+# deletion carries on from where it stopped on the next run.
+def process_account_deletions():
+    limit = app.config.get('USER_DELETE_BATCH_SIZE', 1000)
+    for job in AccountDeletion.select().where(AccountDeletion.finished_date.is_null()).order_by(AccountDeletion.id):
+        for field in user_references + user_rows:
+            while True:
+                with write_transaction():
+                    count = release_user_rows(field, job.user_id, limit)
+                    AccountDeletion.update(done=AccountDeletion.done + count).where(AccountDeletion.id == job.id).execute()
+                if count < limit:
+                    break
+        with write_transaction():
+            User.delete().where(User.id == job.user_id).execute()
+            unindex_name(UserSearch, job.user_id)
+            AccountDeletion.update(finished_date=datetime.datetime.now()).where(AccountDeletion.id == job.id).execute()
+        user_cache.delete(job.username)
+        response_cache.clear()
+
+# Periodic jobs run by the background worker, each with its own connection
+background_tasks = [deliver_notifications, deliver_outbox, process_account_deletions]
+worker_stop = threading.Event()
+
+def run_background_tasks():
+    for task in background_tasks:
+        try:
+            with database.connection_context():
+                task()
+        except Exception:
+            app.logger.exception(f'Background task {task.__name__} failed')
+
+# Run the worker in the foreground, e.g. as a separate process when
+# BACKGROUND_WORKER is disabled for the web server:
+# python3 -c "from app import *; run_worker()"
+def run_worker():
+    while not worker_stop.wait(app.config.get('WORKER_INTERVAL', 5)):
+        run_background_tasks()
+
+def start_background_worker():
+    thread = threading.Thread(target=run_worker, name='worker', daemon=True)
+    thread.start()
+    return thread
+
+# Authenticated users by username, so protected routes don't look the user up
+# on every request. Every write to a User row must call user_cache.delete(), and
+# the cached user may be stale, so routes re-read a user before saving it.
+user_cache = LRUCache(app.config.get('USER_CACHE_SIZE', 1000), ttl=app.config.get('USER_CACHE_TTL', 60))
+
+def get_cached_user(username):
+    data = user_cache.get(username)
+    if data is None:
+        user = User.get(User.username == username)
+        user_cache.set(username, dict(user.__data__))
+        return user
+    return User(**data)
+
+# Passwords
+# pbkdf2 is CPU-bound and holds the GIL, so hashing runs in a pool of
+# PASSWORD_WORKERS processes (0 hashes in the request thread). At most
+# PASSWORD_QUEUE_SIZE hashes can be running or waiting at once; past that,
+# requests get a 503 instead of tying up every server thread.
+password_rounds = app.config.get('PASSWORD_ROUNDS', pbkdf2_sha256.default_rounds)
+password_slots = threading.BoundedSemaphore(app.config.get('PASSWORD_QUEUE_SIZE', 32))
+password_pool_lock = threading.Lock()
+password_pool = None
+
+def hash_password_job(password, rounds):
+    return pbkdf2_sha256.using(rounds=rounds).hash(password)
+
+# Returns whether the password matches and, when the hash was made with other
+# than the configured rounds, a new hash to store in its place
+def verify_password_job(password, hash, rounds):
+    if not pbkdf2_sha256.verify(password, hash):
+        return False, None
+    if pbkdf2_sha256.from_string(hash).rounds != rounds:
+        return True, hash_password_job(password, rounds)
+    return True, None
+
+def run_password_job(job, *args):
+    global password_pool
+    if not app.config.get('PASSWORD_WORKERS', 2):
+        return job(*args)
+    if not password_slots.acquire(blocking=False):
+        count_metric('password_jobs_rejected')
+        raise APIErrorServiceUnavailable('The server is busy, please try again shortly.')
+    try:
+        with password_pool_lock:
+            if password_pool is None:
+                password_pool = ProcessPoolExecutor(app.config.get('PASSWORD_WORKERS', 2), mp_context=multiprocessing.get_context('spawn'))
+            pool = password_pool
+        return pool.submit(job, *args).result()
+    except BrokenProcessPool:
+        # A worker died; start a new pool on the next request
+        with password_pool_lock:
+            if password_pool is pool:
+                password_pool = None
+        raise APIErrorServiceUnavailable('The server is busy, please try again shortly.')
+    finally:
+        password_slots.release()
+
+def hash_password(password):
+    return run_password_job(hash_password_job, password, password_rounds)
+
+def verify_password(password, hash):
+    return run_password_job(verify_password_job, password, hash, password_rounds)
+
+# Token buckets for attempts that lead to hashing: each key may make up to
+# burst attempts at once, refilled at rate attempts per second. Buckets are
+# kept in an LRU, so memory stays bounded however many clients try.
+class Throttle:
+    def __init__(self, rate, burst, size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = LRUCache(size)
+        self.lock = threading.Lock()
+
+    # Take one attempt from the key's bucket. Returns 0 when allowed, or the
+    # number of seconds until the next attempt would be.
+    def acquire(self, key):
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets.set(key, (tokens, now))
+                return (1 - tokens) / self.rate
+            self.buckets.set(key, (tokens - 1, now))
+            return 0
+
+address_throttle = Throttle(app.config.get('LOGIN_THROTTLE_RATE', 0.2), app.config.get('LOGIN_THROTTLE_BURST', 10))
+username_throttle = Throttle(app.config.get('LOGIN_THROTTLE_RATE', 0.2), app.config.get('LOGIN_THROTTLE_BURST', 10))
+
+# Reject the request if the client address, or the username when one is
+# given, has run out of attempts. Call before any hashing.
+def throttle(username=None):
+    # Usernames come straight from the request JSON
+    if username is not None and not isinstance(username, str):
+        raise APIErrorBadRequest('Username value must be a string.')
+    wait = address_throttle.acquire(request.remote_addr)
+    if not wait and username is not None:
+        wait = username_throttle.acquire(username.lower())
+    if wait:
+        count_metric('throttled_requests')
+        raise APIErrorTooManyRequests('Too many attempts, please try again later.', retry_after=int(wait) + 1)
+
+# Tag ids by name. Tags are never renamed or deleted, so entries only leave
+# by eviction. Only tags read back from the database are cached, so a rolled
+# back write can't leave an id behind.
+tag_cache = LRUCache(app.config.get('TAG_CACHE_SIZE', 10000))
+
+# Map a transformation to the given tags, creating the tags that don't exist
+# yet. Call this inside the transaction that creates the transformation.
+def attach_tags(transformation, names, creator):
+    names = list(dict.fromkeys(slugify(name) for name in names if len(name) > 1 and len(name) < 60))
+    if not names:
+        return
+    ids = { name: tag_cache.get(name) for name in names }
+    missing = [name for name, tag_id in ids.items() if tag_id is None]
+    if missing:
+        found = dict(Tag.select(Tag.name, Tag.id).where(Tag.name.in_(missing)).tuples())
+        for name, tag_id in found.items():
+            tag_cache.set(name, tag_id)
+        new_tags = [name for name in missing if name not in found]
+        if new_tags:
+            date = datetime.datetime.now()
+            Tag.insert_many([{ 'created_date': date, 'creator': creator, 'name': name } for name in new_tags]).on_conflict_ignore().execute()
+            created = dict(Tag.select(Tag.name, Tag.id).where(Tag.name.in_(new_tags)).tuples())
+            index_names(TagSearch, { tag_id: name for name, tag_id in created.items() })
+            found.update(created)
+            for name in new_tags:
+                log(f"{creator.username} created a tag ({name}).", initiator=creator, visibility='public')
+        ids.update(found)
+    TransformationToTagMap.insert_many([{ 'transformation': transformation, 'tag': ids[name] } for name in names]).execute()
 
 # Decorator for JWT-secured routes
 def token_required(fn):
@@ -208,7 +1855,7 @@ def token_required(fn):
             raise APIErrorUnauthorized('Not authorized to access this API.')
         try:
             token_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            user = User.get(User.username == token_data['username'])
+            user = get_cached_user(token_data['username'])
         except:
             raise APIErrorUnauthorized('Not authorized to access this API.')
         if not user.is_verified:
@@ -216,37 +1863,96 @@ def token_required(fn):
         return fn(user, *args, **kwargs)
     return decorator
 
-# Request handlers -- these two hooks are provided by flask and we will use them
-# to create and tear down a database connection on each request.
-@app.before_request
-def before_request():
-    g.db = database
-    g.db.connect()
+# Request handlers -- a route takes a connection from the pool when it runs its
+# first query, so static and SPA routes never touch the database. This hook
+# hands the connection back to the pool at the end of the request.
+@app.teardown_request
+def teardown_request(exception):
+    for pool in (database, database.replica):
+        if pool is not None and not pool.is_closed():
+            pool.close()
 
-@app.after_request
-def after_request(response):
-    g.db.close()
-    return response
+# The manifest is read once at startup. Hashed assets never change, so they
+# are cached for a year; index.html is kept in memory with its links pointed
+# at the hashed names and is revalidated with its ETag on every load.
+static_manifest = load_static_manifest()
+static_assets = { entry['path']: entry['encodings'] for entry in static_manifest.values() }
+spa_shell = None
+
+def get_spa_shell():
+    global spa_shell
+    if spa_shell is None:
+        with open(os.path.join(static_dist, 'index.html'), encoding='utf-8') as f:
+            body = rewrite_asset_links(f.read(), static_manifest).encode('utf-8')
+        spa_shell = (body, sha1(body).hexdigest())
+    return spa_shell
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def spa(path):
-    return app.send_static_file("dist/index.html")
+    body, etag = get_spa_shell()
+    response = app.response_class(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/cdn/<path:path>')
 def send_file(path):
-    return send_from_directory(app.static_folder + '/dist', path)
+    if path not in static_assets:
+        return send_from_directory(static_dist, path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    for encoding in static_assets[path]:
+        # quality() honours q-values, so gzip;q=0 turns gzip off
+        if request.accept_encodings.quality(encoding) > 0:
+            response = send_from_directory(static_dist, path + '.' + static_suffixes[encoding], mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Disposition', None)
+            break
+    else:
+        response = send_from_directory(static_dist, path, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/metrics')
+@token_required
+def get_metrics(auth):
+    if not auth.is_admin:
+        raise APIErrorUnauthorized('Not authorized to perform this action.')
+    with metrics_lock:
+        response = dict(metrics)
+    response['log_buffer_depth'] = len(log_buffer.entries)
+    for name, cache in { 'user_cache': user_cache, 'body_cache': body_cache, 'diff_cache': diff_cache, 'tag_cache': tag_cache }.items():
+        for stat, value in cache.stats().items():
+            response[f'{name}_{stat}'] = value
+    return jsonify(response)
 
 @app.route('/log')
+@read_replica
 @token_required
 def get_logs(auth):
     query = (Log
             .select(Log.body, Log.date, Log.visibility, Document.id)
             .where(Log.visibility == ('admin' if auth.is_admin else 'public'))
             # .join(User, on=Log.affected_user)
-            .join(Document, on=Log.affected_document)
-            .order_by(Log.date.desc()))
-    return jsonify([item for item in query.dicts()])
+            .join(Document, on=Log.affected_document))
+    # Optional filters: initiator (username), document (uuid), since and until (ISO dates)
+    if 'initiator' in request.args:
+        initiator = User.get_or_none(User.username == request.args['initiator'])
+        if not initiator:
+            return jsonify([])
+        query = query.where(Log.initiator == initiator)
+    if 'document' in request.args:
+        query = query.where(Document.uuid == request.args['document'])
+    for field, operator in (('since', '__ge__'), ('until', '__lt__')):
+        if field in request.args:
+            try:
+                date = datetime.datetime.fromisoformat(request.args[field])
+            except ValueError:
+                raise APIErrorBadRequest(f'{pretty_field(field)} must be an ISO date.')
+            query = query.where(getattr(Log.date, operator)(date))
+    rows, cursor = paginate_by_date(query, Log.date, Log.id)
+    return paginated(rows, cursor)
 
 
 @app.route('/user', methods=['POST'])
@@ -256,10 +1962,11 @@ def create_user():
     validate(data, 'password', minlength=6, match='repeat_password')
     validate(data, 'repeat_password')
     validate(data, 'email', regex="[^@]+@[^@]+\.[^@]+")
+    throttle()
     # Generate salt and hash the password
-    hash = pbkdf2_sha256.hash(data['password'])
+    hash = hash_password(data['password'])
     try:
-        with database.atomic():
+        with write_transaction():
             user = User.create(
                 username=data['username'],
                 password=hash,
@@ -279,6 +1986,7 @@ def create_user():
                     "https://gosshub.com/reset-token\n\n" +
                     "See you soon,\n\n" +
                     "GossHub")
+            index_names(UserSearch, { user.id: user.username })
             log(f"User {user.username} created.", initiator=user, visibility='public')
             return success('User created.')
     except IntegrityError as e:
@@ -292,9 +2000,9 @@ def get_user(auth):
         validate(request.args, 'username')
         # If we're fetching our own account (or if we're an admin):
         if auth.username == request.args['username'] or auth.is_admin:
-            query = User.select(User.id, User.username, User.join_date, User.email, User.is_admin, User.is_verified).where(User.username.contains(request.args['username']))
+            query = User.select(User.id, User.username, User.join_date, User.email, User.is_admin, User.is_verified).where(name_matches(User.username, UserSearch, request.args['username']))
         else: 
-            query = User.select(User.username, User.join_date).where(User.username.contains(request.args['username']))
+            query = User.select(User.username, User.join_date).where(name_matches(User.username, UserSearch, request.args['username']))
     else:
         # If we're an admin:
         if auth.is_admin:
@@ -305,6 +2013,20 @@ def get_user(auth):
         raise APIErrorNotFound('No matching user found.')
     return jsonify([user for user in query.dicts()])
 
+# Username autocomplete for signed-in users: names containing q=, those
+# starting with it first, at most limit= (SUGGEST_LIMIT by default)
+@app.route('/user/suggest', methods=['GET'])
+@read_replica
+@token_required
+def suggest_users(auth):
+    validate(request.args, 'q')
+    query = (User
+            .select(User.username)
+            .where(name_matches(User.username, UserSearch, request.args['q']))
+            .order_by(Case(None, [(User.username.startswith(request.args['q']), 0)], 1), fn.LENGTH(User.username), User.username)
+            .limit(suggest_limit()))
+    return jsonify([username for username, in query.tuples()])
+
 @app.route('/user', methods=['PUT', 'DELETE'])
 @token_required
 def modify_user(auth):
@@ -318,7 +2040,7 @@ def modify_user(auth):
                 except DoesNotExist:
                     raise APIErrorNotFound('No user found with this ID.')
             else:
-                target_user = auth
+                target_user = User.get_by_id(auth.id)
             if 'username' in data:
                 # Validate the username first - we do this before we start setting values
                 # to prevent ending up in a situation where we change an email and a username
@@ -328,6 +2050,7 @@ def modify_user(auth):
                 if len(existing_user):
                     raise APIErrorBadRequest('This username is taken.')
                 log(f"User {target_user.username} changed their username to {data['username']}.", initiator=auth, visibility='public')
+            previous_username = target_user.username
             for field, new_value in data.items():
                 if field == 'email':
                     # Validate the email
@@ -351,9 +2074,16 @@ def modify_user(auth):
                         "GossHub")
                 elif field == 'password':
                     validate(data, 'password', minlength=6)
-                    new_value = pbkdf2_sha256.hash(data['password'])
+                    new_value = hash_password(data['password'])
                 setattr(target_user, field, new_value)
-            target_user.save()
+            target_user.save(only=target_user.dirty_fields)
+            if target_user.username != previous_username:
+                index_names(UserSearch, { target_user.id: target_user.username })
+                bump_generation('content')
+            user_cache.delete(previous_username)
+            user_cache.delete(target_user.username)
+            # Usernames appear in every document response
+            response_cache.clear()
             return success('User edited.')
         else:
             raise APIErrorBadRequest('No fields specified.')
@@ -366,36 +2096,64 @@ def modify_user(auth):
                 raise APIErrorNotFound('No user found with this ID.')
         else:
             target_user = auth
-        # Free up this user's transformations, comments, tags and logs
-        for transformation in target_user.transformations:
-            transformation.user = None
-            transformation.save()
-        for comment in target_user.comments:
-            comment.user = None
-            comment.save()
-        for tag in target_user.tags:
-            tag.creator = None
-            tag.save()
-        for user_log in Log.select().where(Log.affected_user == target_user):
-            user_log.affected_user = None
-            user_log.save()
-        target_user.delete_instance()
-        log(f"User {target_user.username} deleted.", initiator=auth, visibility='public')
+        initiator = auth if auth.id != target_user.id else None
+        # Very large accounts can be deleted by the background worker instead,
+        # with progress at GET /user/deletion?token=. The account is disabled
+        # straight away.
+        if request.args.get('background', 'false').lower() in ('true', '1'):
+            with write_transaction():
+                User.update(is_verified=False).where(User.id == target_user.id).execute()
+                job = AccountDeletion.create(
+                    token=token_urlsafe(16),
+                    user_id=target_user.id,
+                    username=target_user.username,
+                    created_date=datetime.datetime.now(),
+                    total=count_user_rows(target_user.id))
+            user_cache.delete(target_user.username)
+            log(f"User {target_user.username} queued for deletion.", initiator=initiator, visibility='public')
+            return jsonify({ "status": 202, "message": 'User deletion started.', "token": job.token }), 202
+        # Free up this user's transformations, comments, tags and logs, and
+        # drop their watches and pending notifications
+        delete_user(target_user.id)
+        user_cache.delete(target_user.username)
+        response_cache.clear()
+        log(f"User {target_user.username} deleted.", initiator=initiator, visibility='public')
         return success('User deleted.')
 
+# Progress of a background account deletion
+@app.route('/user/deletion', methods=['GET'])
+def account_deletion():
+    validate(request.args, 'token')
+    job = AccountDeletion.get_or_none(AccountDeletion.token == request.args['token'])
+    if not job:
+        raise APIErrorNotFound('No matching account deletion found.')
+    return jsonify({
+        "username": job.username,
+        "status": 'done' if job.finished_date else 'running' if job.done else 'pending',
+        "done": job.done,
+        "total": job.total,
+        "created_date": job.created_date,
+        "finished_date": job.finished_date,
+    })
+
 @app.route('/login', methods=['POST'])
 def login():
     data = sanitize(request.json)
     validate(data, 'username')
     validate(data, 'password')
+    throttle(data['username'])
     try:
         user = User.get(User.username == data['username'])
     except DoesNotExist: 
         raise APIErrorNotFound('No user found with this username.')
     user = model_to_dict(user)
-    hash_matches = pbkdf2_sha256.verify(data['password'], user['password'])
+    hash_matches, new_hash = verify_password(data['password'], user['password'])
     if not hash_matches:
         raise APIErrorUnauthorized('Username or password incorrect.')
+    # Upgrade hashes made before PASSWORD_ROUNDS last changed
+    if new_hash:
+        User.update(password=new_hash).where((User.id == user['id']) & (User.password == user['password'])).execute()
+        user_cache.delete(user['username'])
     if not user['is_verified']:
         raise APIErrorUnauthorized('Email address has not been verified.')
     # Create a JWT token for this user
@@ -414,9 +2172,13 @@ def verify_email():
         token_data = jwt.decode(user.verification_token, app.config['SECRET_KEY'], algorithms=["HS256"])
     except:
         raise APIErrorBadRequest('This verification token is invalid.')
+    # Accounts queued for deletion stay disabled until the worker removes them
+    if deletion_pending(user.id):
+        raise APIErrorBadRequest('This account is being deleted.')
     user.is_verified = True
     user.verification_token = ""
     user.save()
+    user_cache.delete(user.username)
     log(f"User {user.username} verified their email.", initiator=user)
     return success('Email verified.')
 
@@ -428,8 +2190,11 @@ def reset_token():
         user = User.get((User.email == data['email']) & (User.is_verified == False))
     except DoesNotExist: 
         return success('Token reset.')
+    if deletion_pending(user.id):
+        raise APIErrorBadRequest('This account is being deleted.')
     user.verification_token=jwt.encode({ 'username': user.username, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1) }, app.config['SECRET_KEY'], algorithm="HS256")
     user.save()
+    user_cache.delete(user.username)
     # Send email with verification token
     send_email(
         to=user.email,
@@ -453,6 +2218,7 @@ def reset_password():
         return success('Token reset.')
     user.verification_token=jwt.encode({ 'username': user.username, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1) }, app.config['SECRET_KEY'], algorithm="HS256")
     user.save()
+    user_cache.delete(user.username)
     # Send email with verification token
     send_email(
         to=user.email,
@@ -473,8 +2239,9 @@ def new_password():
     validate(data, 'password', minlength=6, match='repeat_password')
     validate(data, 'repeat_password')
     validate(data, 'verification_token')
+    throttle()
     # Generate salt and hash the password
-    hash = pbkdf2_sha256.hash(data['password'])
+    hash = hash_password(data['password'])
     try:
         user = User.get((User.verification_token == data['verification_token']))
     except DoesNotExist: 
@@ -486,6 +2253,7 @@ def new_password():
     user.password = hash
     user.verification_token = ""
     user.save()
+    user_cache.delete(user.username)
     # Send confirmation email
     send_email(
         to=user.email,
@@ -499,87 +2267,132 @@ def new_password():
     return success('Password updated.')
 
 @app.route('/document', methods=['GET'])
+@read_replica
+@cached_response(document_version)
 def get_document():
-    # We want a single document, and all its edit history, watches, and comments.
+    # We want a single document, and its edit history, watches, and comments.
+    # The history is returned whole unless limit=, page= or cursor= is given,
+    # and bodies=false leaves out the revision bodies (see /document/revision).
     if request.args and 'uuid' in request.args:
         validate(request.args, 'uuid')
-        query = (Document
-                .select(Document.id.alias('document_id'), Document.uuid, Transformation.id, Transformation.hash, Transformation.date, Transformation.body, User.username)
-                .where(Document.uuid == request.args['uuid'])
-                .join(Transformation)
-                .join(User, JOIN.LEFT_OUTER)
-                .group_by(Transformation)
-                .order_by(Transformation.date.desc()))
-        if not len(query):
+        document = Document.get_or_none(Document.uuid == request.args['uuid'])
+        if not document:
             raise APIErrorNotFound('No matching document found.')
-        comments_query = (Comment
-                .select(Comment.id, Comment.date, Comment.body, Comment.parent_id.alias('parent_id'), User.username)
-                .where(Comment.document == query[0].document_id)
+        with_bodies = request.args.get('bodies', 'true').lower() not in ('false', '0')
+        fields = [Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, User.username]
+        if with_bodies:
+            fields += [Transformation.body, Transformation.storage, Transformation.base_id.alias('base_id')]
+        query = (Transformation
+                .select(*fields)
                 .join(User, JOIN.LEFT_OUTER)
-                .order_by(Comment.id.asc()))
-        watches_query = (Watch
-                .select(User.username)
-                .where(Watch.document == query[0].document_id)
-                .join(User, JOIN.LEFT_OUTER))
-        transformations = []
-        for transformation in query.dicts():
-            tags = []
-            tag_mappings = TransformationToTagMap.select().where(TransformationToTagMap.transformation_id == transformation['id'])
-            if len(tag_mappings):
-                for mapping in tag_mappings:
-                    tags.append(Tag.get_by_id(mapping.tag_id).name)
-            transformations.append({
-                'username': transformation['username'],
-                'hash': transformation['hash'],
-                'date': transformation['date'],
-                'body': transformation['body'],
-                'tags': tags
-            })
-        return jsonify({
-            "uuid": query[0].uuid,
-            "comments": [comment for comment in comments_query.dicts()],
-            "watches": [watch.user.username for watch in watches_query],
-            "transformations": transformations,
-        })
-    # We want all the documents, but just the most recent transformation for each
-    Author = User.alias()
-    Latest = Transformation.alias()
-    cte = (Latest
-            .select(Latest.document_id, fn.MAX(Latest.date).alias('max_date'))
-            .group_by(Latest.document_id)
-            .cte('latest'))
-    predicate = ((Document.id == cte.c.document_id) &
-                (Transformation.date == cte.c.max_date))
-    query = (Document
-            .select(Document.uuid, Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, Transformation.body, Author.username)
-            .where(Transformation.body.contains(request.args['query']) if request.args and 'query' in request.args else None)
-            .join(cte, on=predicate)
-            .join_from(Document, Transformation)
-            .join_from(Transformation, Author, JOIN.LEFT_OUTER)
-            .order_by(Transformation.date.desc())
-            .with_cte(cte)
-            .paginate(int(request.args['page']) if request.args and 'page' in request.args else 1, 20))
-    response = []
-    for document in query.dicts():
-        tags = []
-        tag_mappings = TransformationToTagMap.select().where(TransformationToTagMap.transformation_id == document['transformation_id'])
-        if len(tag_mappings):
-            for mapping in tag_mappings:
-                tags.append(Tag.get_by_id(mapping.tag_id).name)
-        response_document = {
-            'uuid': document['uuid'],
-            'transformations': [
-                {
-                    'hash': document['hash'],
-                    'username': document['username'],
-                    'body': document['body'],
-                    'date': document['date'],
-                    'tags': tags
-                }
-            ]
+                .where(Transformation.document == document))
+        cursor = None
+        if any(argument in request.args for argument in ('limit', 'page', 'cursor')):
+            rows, cursor = paginate_by_date(query, Transformation.date, Transformation.id)
+        else:
+            rows = list(query.order_by(Transformation.date.desc(), Transformation.id.desc()).dicts())
+        response = {
+            "uuid": document.uuid,
+            "transformations": serialize_transformations(rows, with_bodies),
         }
-        response.append(response_document)
-    return jsonify(response)
+        # Later pages of the history only carry transformations
+        if 'cursor' not in request.args and page_number() == 1:
+            comments_query = (Comment
+                    .select(Comment.id, Comment.date, Comment.body, Comment.parent_id.alias('parent_id'), User.username)
+                    .where(Comment.document == document)
+                    .join(User, JOIN.LEFT_OUTER)
+                    .order_by(Comment.id.asc()))
+            watches_query = (Watch
+                    .select(User.username)
+                    .where(Watch.document == document)
+                    .join(User, JOIN.LEFT_OUTER))
+            response['comments'] = [comment for comment in comments_query.dicts()]
+            response['watches'] = [watch['username'] for watch in watches_query.dicts()]
+        return paginated(response, cursor)
+    # We want all the documents, but just the most recent transformation for each
+    if request.args and 'query' in request.args and is_sqlite:
+        # Full-text search over the current body of each document, best matches first
+        expression = search_expression(request.args['query'])
+        if not expression:
+            return jsonify([])
+        snippet = fn.snippet(DocumentSearch._meta.entity, 0, snippet_start, snippet_end, '…', 16)
+        query = (DocumentHead
+                .select(Document.uuid, Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, Transformation.body, User.username, snippet.alias('snippet'))
+                .join(Document)
+                .join(DocumentSearch, on=(DocumentSearch.rowid == Document.id))
+                .join_from(DocumentHead, Transformation)
+                .join_from(Transformation, User, JOIN.LEFT_OUTER)
+                .where(DocumentSearch.match(expression))
+                .order_by(DocumentSearch.bm25(), DocumentHead.document.desc()))
+        rows, cursor = paginate_ranked(query)
+        return paginated(serialize_documents(rows), cursor)
+    query = (DocumentHead
+            .select(Document.uuid, Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, Transformation.body, User.username)
+            .join(Document)
+            .join_from(DocumentHead, Transformation)
+            .join_from(Transformation, User, JOIN.LEFT_OUTER))
+    if request.args and 'query' in request.args:
+        # Without FTS5, match the current bodies directly
+        query = query.where(Transformation.body.contains(request.args['query']))
+    rows, cursor = paginate_by_date(query, DocumentHead.date, DocumentHead.document)
+    return paginated(serialize_documents(rows), cursor)
+
+# A single revision of a document by its transformation hash, body included
+@app.route('/document/revision', methods=['GET'])
+@read_replica
+def get_revision():
+    validate(request.args, 'uuid')
+    validate(request.args, 'hash')
+    rows = list(Transformation
+            .select(Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, Transformation.body, Transformation.storage, Transformation.base_id.alias('base_id'), User.username)
+            .join_from(Transformation, Document)
+            .join_from(Transformation, User, JOIN.LEFT_OUTER)
+            .where((Document.uuid == request.args['uuid']) & (Transformation.hash == request.args['hash']))
+            .dicts())
+    if not rows:
+        raise APIErrorNotFound('There is no document version matching this hash.')
+    return jsonify({
+        "uuid": request.args['uuid'],
+        "transformation": serialize_transformations(rows)[0],
+    })
+
+# Diff two revisions of a document: from= and to= are transformation hashes,
+# by= is 'line' (default) or 'word' and context= the number of unchanged
+# lines kept around each hunk
+@app.route('/document/diff', methods=['GET'])
+@read_replica
+def get_diff():
+    validate(request.args, 'uuid')
+    validate(request.args, 'from')
+    validate(request.args, 'to')
+    granularity = request.args.get('by', 'line')
+    if granularity not in diff_granularities:
+        raise APIErrorBadRequest('Diffs are by line or by word.')
+    try:
+        context = max(0, min(int(request.args.get('context', 3)), 100))
+    except ValueError:
+        raise APIErrorBadRequest('Context must be a number.')
+    key = (request.args['uuid'], request.args['from'], request.args['to'], granularity, context)
+    hunks = diff_cache.get(key)
+    if hunks is None:
+        rows = list(Transformation
+                .select(Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.body, Transformation.storage, Transformation.base_id.alias('base_id'))
+                .join(Document)
+                .where((Document.uuid == request.args['uuid']) & (Transformation.hash.in_([request.args['from'], request.args['to']])))
+                .dicts())
+        ids = { row['hash']: row['transformation_id'] for row in rows }
+        if request.args['from'] not in ids or request.args['to'] not in ids:
+            raise APIErrorNotFound('There is no document version matching this hash.')
+        bodies = transformation_bodies(rows)
+        hunks = diff_hunks(bodies[ids[request.args['from']]], bodies[ids[request.args['to']]], granularity, context)
+        diff_cache.set(key, hunks)
+    return jsonify({
+        "uuid": request.args['uuid'],
+        "from": request.args['from'],
+        "to": request.args['to'],
+        "by": granularity,
+        "hunks": hunks,
+    })
 
 @app.route('/document', methods=['POST', 'PUT', 'DELETE'])
 @token_required
@@ -592,29 +2405,21 @@ def document(auth):
         uuid = shortuuid.uuid()
         while len(Document.select().where(Document.uuid == uuid)) > 0:
             uuid = shortuuid.uuid()
-        document = Document.create(
-            created_date=date,
-            uuid = uuid)
-        transformation = Transformation.create(
-            hash=transformation_hash(date, data['body']),
-            date=date,
-            document=document,
-            user=auth,
-            body=data['body'])
-        if 'tags' in data:
-            existing_tags = [tag.name for tag in Tag.select()]
-            tags_to_attach = [slugify(tag) for tag in data['tags'][:3] if len(tag) > 1 and len(tag) < 60]
-            new_tags = [tag for tag in tags_to_attach if tag not in existing_tags]
-            for tag in new_tags:
-                new_tag = Tag.create(
-                        created_date=datetime.datetime.now(),
-                        creator=auth,
-                        name=tag)
-                log(f"{auth.username} created a tag ({new_tag.name}).", initiator=auth, visibility='public')
-            for tag in tags_to_attach:
-                tag_field = Tag.get(Tag.name == tag)
-                map = TransformationToTagMap.create(transformation=transformation, tag=tag_field)
-        log(f"{auth.username} created a document.", initiator=auth, affected_document=document, visibility='public')
+        with write_transaction():
+            document = Document.create(
+                created_date=date,
+                uuid = uuid)
+            transformation = Transformation.create(
+                hash=transformation_hash(date, data['body']),
+                date=date,
+                document=document,
+                user=auth,
+                body=data['body'])
+            if 'tags' in data:
+                attach_tags(transformation, data['tags'][:3], auth)
+            set_document_head(document, transformation)
+            log(f"{auth.username} created a document.", initiator=auth, affected_document=document, visibility='public')
+        invalidate_responses('get_document', 'tag')
         return success('Document created.')
     elif request.method == 'PUT':
         data = sanitize(request.json)
@@ -624,38 +2429,23 @@ def document(auth):
             document = Document.get(Document.uuid == request.args['uuid'])
         except DoesNotExist:
             raise APIErrorNotFound('No matching document found.')
-        date = datetime.datetime.now()
-        transformation = Transformation.create(
-            hash=transformation_hash(date, data['body']),
-            date=date,
-            document=document,
-            user=auth,
-            body=data['body'])
-        if 'tags' in data:
-            existing_tags = [tag.name for tag in Tag.select()]
-            tags_to_attach = [slugify(tag) for tag in data['tags'] if len(tag) > 1 and len(tag) < 60]
-            new_tags = [tag for tag in tags_to_attach if tag not in existing_tags]
-            for tag in new_tags:
-                new_tag = Tag.create(
-                        created_date=datetime.datetime.now(),
-                        creator=auth,
-                        name=tag)
-                log(f"{auth.username} created a tag ({new_tag.name}).", initiator=auth, visibility='public')
-            for tag in tags_to_attach:
-                tag_field = Tag.get(Tag.name == tag)
-                map = TransformationToTagMap.create(transformation=transformation, tag=tag_field)
-        log(f"{auth.username} edited a document.", initiator=auth, affected_document=document, visibility='public')
-        # Update watchers
-        watchers = Watch.select().where((Watch.document == document) & (Watch.user != auth))
-        for row in watchers:
-            send_email(
-                to=row.user.email,
-                subject='Document updated on GossHub',
-                body="Hi!\n\n" +
-                f"A document you're watching has been updated by {auth.username}. Follow this link to see the update:\n" +
-                f"https://gosshub.com/document/{document.uuid}/hash/{transformation.hash}\n\n" +
-                "Best,\n\n" +
-                "GossHub")
+        with write_transaction():
+            previous = Transformation.select().join(DocumentHead).where(DocumentHead.document == document).get()
+            date = datetime.datetime.now()
+            transformation = Transformation.create(
+                hash=transformation_hash(date, data['body']),
+                date=date,
+                document=document,
+                user=auth,
+                body=data['body'])
+            if 'tags' in data:
+                attach_tags(transformation, data['tags'], auth)
+            set_document_head(document, transformation)
+            store_previous_revision(previous, transformation)
+            log(f"{auth.username} edited a document.", initiator=auth, affected_document=document, visibility='public')
+            # Update watchers
+            notify(document, auth, 'edit', f"https://gosshub.com/document/{document.uuid}/hash/{transformation.hash}")
+        invalidate_responses('get_document', 'tag')
         return success('Document edited.')
     elif request.method == 'DELETE':
         return success('Endpoint not enabled.')
@@ -675,6 +2465,8 @@ def modify_page(auth):
             slug=slugify(data['slug']),
             title=data['title'],
             body=data['body'])
+        bump_generation('pages')
+        invalidate_responses('page')
         return success('Page created.')
     elif request.method == 'PUT':
         # Only allowed for admins
@@ -690,7 +2482,10 @@ def modify_page(auth):
             raise APIErrorNotFound('No matching page found.')
         page.body = data['body']
         page.title = data['title']
+        page.revision += 1
         page.save()
+        bump_generation('pages')
+        invalidate_responses('page')
         return success('Page edited.')
     elif request.method == 'DELETE':
         # Only allowed for admins
@@ -702,9 +2497,13 @@ def modify_page(auth):
         except DoesNotExist:
             raise APIErrorNotFound('No matching page found.')
         page.delete_instance()
+        bump_generation('pages')
+        invalidate_responses('page')
         return success('Page deleted.')
 
 @app.route('/page', methods=['GET'])
+@read_replica
+@cached_response(page_version)
 def page():
     if request.args:
         validate(request.args, 'slug')
@@ -724,74 +2523,122 @@ def page():
         return jsonify([{ 'body': page.body, 'title': page.title, 'slug': page.slug } for page in query])
 
 @app.route('/tag', methods=['GET'])
+@read_replica
+@cached_response(heads_version)
 def tag():
     if request.args:
-        # Return all documents and their most recent transformation for a specific tag
+        # Return all documents and their most recent transformation for a
+        # specific tag, whole unless limit=, page= or cursor= is given
         validate(request.args, 'slug')
         try:
             tag = Tag.get(Tag.name == request.args['slug'])
         except DoesNotExist:
             raise APIErrorNotFound('No matching tag found.')
-        Author = User.alias()
-        Latest = Transformation.alias()
-        cte = (Latest
-            .select(Latest.document_id, fn.MAX(Latest.date).alias('max_date'))
-            .group_by(Latest.document_id)
-            .cte('latest'))
-        predicate = ((Document.id == cte.c.document_id) &
-                    (Transformation.date == cte.c.max_date))
-        query = (Document
-            .select(Document.uuid, Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, Transformation.body, Author.username)
-            .where(TransformationToTagMap.tag_id == tag.id)
-            .join(cte, on=predicate)
-            .join_from(Document, Transformation)
-            .join(TransformationToTagMap)
-            .join(Tag)
-            .join_from(Transformation, Author, JOIN.LEFT_OUTER)
-            .order_by(Transformation.date.desc())
-            .with_cte(cte)
-            .group_by(Document))
-        response = []
-        for document in query.dicts():
-            tags = []
-            tag_mappings = TransformationToTagMap.select().where(TransformationToTagMap.transformation_id == document['transformation_id'])
-            if len(tag_mappings):
-                for mapping in tag_mappings:
-                    tags.append(Tag.get_by_id(mapping.tag_id).name)
-            response_document = {
-                'uuid': document['uuid'],
-                'transformations': [
-                    {
-                        'hash': document['hash'],
-                        'username': document['username'],
-                        'body': document['body'],
-                        'date': document['date'],
-                        'tags': tags
-                    }
-                ]
-            }
-            response.append(response_document)
-        return jsonify(response)
+        query = (DocumentHeadTag
+            .select(Document.uuid, Transformation.id.alias('transformation_id'), Transformation.hash, Transformation.date, Transformation.body, User.username)
+            .join(DocumentHead, on=(DocumentHead.document == DocumentHeadTag.document))
+            .join_from(DocumentHeadTag, Document)
+            .join_from(DocumentHead, Transformation)
+            .join_from(Transformation, User, JOIN.LEFT_OUTER)
+            .where(DocumentHeadTag.tag == tag))
+        cursor = None
+        if any(argument in request.args for argument in ('limit', 'page', 'cursor')):
+            rows, cursor = paginate_by_date(query, DocumentHeadTag.date, DocumentHeadTag.document)
+        else:
+            rows = list(query.order_by(DocumentHeadTag.date.desc(), DocumentHeadTag.document.desc()).dicts())
+        return paginated(serialize_documents(rows), cursor)
     else:
         # Return all tags and the number of documents per tag.
-        Latest = Transformation.alias()
-        cte = (Latest
-            .select(Latest.document_id, fn.MAX(Latest.date).alias('max_date'))
-            .group_by(Latest.document_id)
-            .cte('latest'))
-        predicate = ((Document.id == cte.c.document_id) &
-                    (Transformation.date == cte.c.max_date))
-        query = (Document
-            .select(Tag.name, fn.Count(Document.uuid).alias('count'))
-            .join(cte, on=predicate)
-            .join(Transformation)
-            .join(TransformationToTagMap)
-            .join(Tag)
-            .with_cte(cte)
-            .order_by(SQL('count').desc())
-            .group_by(Tag).dicts())
+        query = (Tag
+            .select(Tag.name, TagStats.count)
+            .join(TagStats)
+            .where(TagStats.count > 0)
+            .order_by(TagStats.count.desc(), Tag.name)
+            .dicts())
         return jsonify([ row for row in query ])
 
+# Tag autocomplete: tags containing q=, those starting with it first, then the
+# most used, at most limit= (SUGGEST_LIMIT by default)
+@app.route('/tag/suggest', methods=['GET'])
+@read_replica
+def suggest_tags():
+    validate(request.args, 'q')
+    text = request.args['q'].lower()
+    query = (Tag
+            .select(Tag.name, fn.COALESCE(TagStats.count, 0).alias('count'))
+            .join(TagStats, JOIN.LEFT_OUTER)
+            .where(name_matches(Tag.name, TagSearch, text))
+            .order_by(Case(None, [(Tag.name.startswith(text), 0)], 1), fn.COALESCE(TagStats.count, 0).desc(), Tag.name)
+            .limit(suggest_limit()))
+    return jsonify([row for row in query.dicts()])
+
+# Comment threads of a document, oldest first: a page of top-level comments,
+# each with its replies nested up to depth= levels down (at most
+# COMMENT_DEPTH). Comments whose replies were cut off carry more_replies, and
+# parent= returns the threads under that comment instead. The page of threads
+# and all their replies come from one query over a recursive CTE.
+@app.route('/comment', methods=['GET'])
+@read_replica
+@cached_response(document_version)
+def get_comments():
+    validate(request.args, 'uuid')
+    document = Document.get_or_none(Document.uuid == request.args['uuid'])
+    if not document:
+        raise APIErrorNotFound('No matching document found.')
+    max_depth = app.config.get('COMMENT_DEPTH', 5)
+    try:
+        depth = max(0, min(int(request.args.get('depth', max_depth)), max_depth))
+        parent = int(request.args['parent']) if 'parent' in request.args else None
+    except ValueError:
+        raise APIErrorBadRequest('Depth and parent must be numbers.')
+    limit = page_size()
+    roots = (Comment
+            .select(Comment.id)
+            .where((Comment.document == document) & (Comment.parent == parent if parent else Comment.parent.is_null()))
+            .order_by(Comment.id)
+            .limit(limit))
+    if 'cursor' in request.args:
+        try:
+            roots = roots.where(Comment.id > int(decode_cursor(request.args['cursor'])['id']))
+        except (KeyError, TypeError, ValueError):
+            raise APIErrorBadRequest('Invalid cursor.')
+    else:
+        roots = roots.offset((page_number() - 1) * limit)
+    # One level more than asked for, to tell which comments have more replies
+    base = (Comment
+            .select(Comment.id, Value(0).alias('depth'))
+            .where(Comment.id.in_(roots))
+            .cte('thread', recursive=True, columns=('id', 'depth')))
+    Reply = Comment.alias()
+    recursive = (Reply
+            .select(Reply.id, base.c.depth + 1)
+            .join(base, on=(Reply.parent == base.c.id))
+            .where(base.c.depth <= depth))
+    thread = base.union_all(recursive)
+    rows = (Comment
+            .select(Comment.id, Comment.date, Comment.body, Comment.parent_id.alias('parent_id'), User.username, thread.c.depth)
+            .join(thread, on=(Comment.id == thread.c.id))
+            .join_from(Comment, User, JOIN.LEFT_OUTER)
+            .with_cte(thread)
+            .order_by(Comment.id))
+    # Replies always have a higher id than their parent, so parents come first
+    comments = {}
+    threads = []
+    for row in rows.dicts():
+        if row['depth'] > depth:
+            comments[row['parent_id']]['more_replies'] = True
+            continue
+        comment = comments[row['id']] = { key: value for key, value in row.items() if key != 'depth' }
+        comment['replies'] = []
+        if row['depth'] == 0:
+            threads.append(comment)
+        else:
+            comments[row['parent_id']]['replies'].append(comment)
+    cursor = None
+    if len(threads) == limit:
+        cursor = encode_cursor({ 'id': threads[-1]['id'] })
+    return paginated(threads, cursor)
+
 @app.route('/comment', methods=['POST'])
 @token_required
 def create_comment(auth):
@@ -807,30 +2654,20 @@ def create_comment(auth):
     if 'parent_id' in data:
         # This is a child comment - verify the parent exists
         # and belongs to this document.
-        parent_query = (Comment
-            .select()
-            .where((Comment.id == data['parent_id']) & (Comment.document.uuid == data['uuid']))
-            .join(Document))
-        if not len(parent_query):
+        parent = Comment.get_or_none((Comment.id == data['parent_id']) & (Comment.document == document))
+        if not parent:
             raise APIErrorBadRequest('No matching parent comment found.')
-        parent = parent_query[0]
-    comment = Comment.create(
-        date=datetime.datetime.now(),
-        body=data['body'],
-        user=auth,
-        document=document,
-        parent=parent)
-    # Update watchers
-    watchers = Watch.select().where((Watch.document == document) & (Watch.user != auth))
-    for row in watchers:
-        send_email(
-            to=row.user.email,
-            subject='New comment on GossHub',
-            body="Hi!\n\n" +
-            f"The user {auth.username} has commented on a document you're following on GossHub. Follow this link to see the update:\n" +
-            f"https://gosshub.com/document/{document.uuid}\n\n" +
-            "Best,\n\n" +
-            "GossHub")
+    with write_transaction():
+        comment = Comment.create(
+            date=datetime.datetime.now(),
+            body=data['body'],
+            user=auth,
+            document=document,
+            parent=parent)
+        touch_document(document)
+        # Update watchers
+        notify(document, auth, 'comment', f"https://gosshub.com/document/{document.uuid}")
+    invalidate_responses('get_document', 'get_comments')
     return success('Comment created.')
 
 @app.route('/watch', methods=['POST', 'DELETE'])
@@ -847,9 +2684,15 @@ def watch(auth):
             existing_watch = Watch.get((Watch.user == auth) & (Watch.document == document))
             return success('Watch already exists.')
         except DoesNotExist:
-            watch = Watch.create(
-                user=auth,
-                document=document)
+            try:
+                watch = Watch.create(
+                    user=auth,
+                    document=document)
+            except IntegrityError:
+                # Another request created it first
+                return success('Watch already exists.')
+            touch_document(document)
+            invalidate_responses('get_document')
             return success('Watch created.')
     elif request.method == 'DELETE':
         if request.args and 'uuid' in request.args:
@@ -862,6 +2705,8 @@ def watch(auth):
             except DoesNotExist:
                 raise APIErrorNotFound('No watch found for this document.')
             existing_watch.delete_instance()
+            touch_document(document)
+            invalidate_responses('get_document')
             return success('Watch deleted.')
         else:
             raise APIErrorBadRequest('No UUID specified.')
@@ -869,4 +2714,6 @@ def watch(auth):
 # Allow running from the command line
 if __name__ == '__main__':
     create_tables()
+    if app.config.get('BACKGROUND_WORKER', True):
+        start_background_worker()
     serve(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,18 @@
+# Benchmarks for the GossHub server. Run from the server folder, next to
+# config.toml:
+#
+#   python3 -m bench generate --db bench.db --documents 1000 --revisions 5
+#   python3 -m bench run --db bench.db --output before.json
+#   python3 -m bench run --db bench.db --http --concurrency 8
+#   python3 -m bench run --db bench.db --http --concurrency 8 --mixed
+#   python3 -m bench static
+#   python3 -m bench transfer --db bench.db
+#
+# generate builds a synthetic knowledge base with the app's own models. run
+# copies it and drives the app through the Flask test client (or over HTTP,
+# against serve() started in-process or a server given with --url), and
+# reports latency percentiles, SQL statements per request and throughput per
+# endpoint. With --mixed, reads and document writes run concurrently instead,
+# which is how connection pooling and WAL show up; point --url at a server
+# from another commit to compare. The JSON written by --output has stable
+# keys, so results from two commits can be diffed.
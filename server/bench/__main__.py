@@ -0,0 +1,58 @@
+import argparse
+from bench.generate import generate
+from bench.run import run, static, transfer
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m bench', description='Benchmark the GossHub server.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('generate', help='build a synthetic knowledge base')
+    command.add_argument('--db', default='bench.db')
+    command.add_argument('--users', type=int, default=50)
+    command.add_argument('--documents', type=int, default=1000)
+    command.add_argument('--revisions', type=int, default=5, help='revisions per document')
+    command.add_argument('--tags', type=int, default=3, help='tags per revision')
+    command.add_argument('--tag-pool', type=int, default=200, help='distinct tags')
+    command.add_argument('--comments', type=int, default=3, help='comments per document')
+    command.add_argument('--watches', type=int, default=2, help='watchers per document')
+    command.add_argument('--lines', type=int, default=20, help='lines per body')
+    command.add_argument('--seed', type=int, default=1)
+
+    command = commands.add_parser('run', help='benchmark the API endpoints')
+    command.add_argument('--db', default='bench.db')
+    command.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    command.add_argument('--concurrency', type=int, default=1)
+    command.add_argument('--warmup', type=int, default=10)
+    command.add_argument('--http', action='store_true', help='go through serve() in this process')
+    command.add_argument('--url', help='benchmark a running server instead')
+    command.add_argument('--only', nargs='*', help='endpoints whose name contains any of these')
+    command.add_argument('--mixed', action='store_true', help='send reads and document writes at the same time')
+    command.add_argument('--write-share', type=float, default=0.2, help='share of writes with --mixed')
+    command.add_argument('--seed', type=int, default=1)
+    command.add_argument('--output', help='write the results as JSON')
+
+    command = commands.add_parser('static', help='compare original and precompressed static assets')
+    command.add_argument('--requests', type=int, default=200)
+    command.add_argument('--concurrency', type=int, default=1)
+    command.add_argument('--http', action='store_true')
+    command.add_argument('--output')
+
+    command = commands.add_parser('transfer', help='time export_data() and import_data()')
+    command.add_argument('--db', default='bench.db')
+    command.add_argument('--output')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args.db, users=args.users, documents=args.documents, revisions=args.revisions, tags=args.tags,
+                comments=args.comments, watches=args.watches, tag_pool=args.tag_pool, lines=args.lines, seed=args.seed)
+    elif args.command == 'run':
+        run(args.db, count=args.requests, concurrency=args.concurrency, warmup=args.warmup, http=args.http,
+                url=args.url, only=args.only, seed=args.seed, output=args.output, mixed=args.mixed, write_share=args.write_share)
+    elif args.command == 'static':
+        static(count=args.requests, concurrency=args.concurrency, http=args.http, output=args.output)
+    elif args.command == 'transfer':
+        print(transfer(args.db, output=args.output)['results'])
+
+# Password hashing workers re-import this module, so only run when invoked
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import datetime
+import os
+import random
+import time
+from peewee import chunked
+import app as server
+
+# A fixed vocabulary of made-up words, so bodies, tags and search terms are
+# the same for a given seed on every machine
+syllables = ['ka', 'lo', 'mi', 'ren', 'tor', 'shu', 'vel', 'dan', 'por', 'ix', 'e', 'ul', 'an', 'ber', 'cos', 'ti']
+words = [first + second for first in syllables for second in syllables]
+uuid_alphabet = '23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+password = 'password'
+
+# Point the app's models at another SQLite file
+def use_database(path):
+    server.database.close_all()
+    server.database.init(path)
+    server.database.replica = None
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def random_line(rng):
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(6, 14)))
+
+# Build a knowledge base at the given scale. Every user's password is
+# 'password' and user1 is an admin. Each revision rewrites a few lines of the
+# previous one, so diffs and delta storage see realistic edits.
+def generate(path, users=50, documents=1000, revisions=5, tags=3, comments=3, watches=2, tag_pool=200, lines=20, seed=1):
+    rng = random.Random(seed)
+    started = time.monotonic()
+    remove_database(path)
+    use_database(path)
+    server.create_tables()
+    start = datetime.datetime(2024, 1, 1)
+    password_hash = server.hash_password_job(password, server.password_rounds)
+    user_ids = list(range(1, users + 1))
+    tag_ids = list(range(1, tag_pool + 1))
+    counts = { 'users': users, 'tags': tag_pool, 'documents': documents, 'revisions': 0, 'comments': 0, 'watches': 0 }
+    with server.database.connection_context():
+        with server.write_transaction():
+            server.User.insert_many([{
+                'id': user_id,
+                'username': f'user{user_id}',
+                'password': password_hash,
+                'email': f'user{user_id}@example.com',
+                'join_date': start,
+                'is_admin': user_id == 1,
+                'is_verified': True,
+            } for user_id in user_ids]).execute()
+            server.Tag.insert_many([{
+                'id': tag_id,
+                'created_date': start,
+                'creator': rng.choice(user_ids),
+                'name': f'{rng.choice(words)}-{tag_id}',
+            } for tag_id in tag_ids]).execute()
+        transformation_id = comment_id = 0
+        for batch in chunked(range(1, documents + 1), 200):
+            rows = { 'document': [], 'transformation': [], 'transformationtotagmap': [], 'comment': [], 'watch': [], 'log': [] }
+            for document_id in batch:
+                date = start + datetime.timedelta(minutes=document_id)
+                rows['document'].append({ 'id': document_id, 'created_date': date, 'uuid': ''.join(rng.choice(uuid_alphabet) for _ in range(22)) })
+                body = [random_line(rng) for _ in range(lines)]
+                for revision in range(revisions):
+                    if revision:
+                        for line in rng.sample(range(lines), min(3, lines)):
+                            body[line] = random_line(rng)
+                    transformation_id += 1
+                    author = rng.choice(user_ids)
+                    text = '\n'.join(body)
+                    revision_date = date + datetime.timedelta(seconds=revision)
+                    rows['transformation'].append({
+                        'id': transformation_id,
+                        'hash': server.transformation_hash(revision_date, f'{transformation_id}:{text}'),
+                        'date': revision_date,
+                        'document': document_id,
+                        'user': author,
+                        'body': text,
+                    })
+                    for tag_id in rng.sample(tag_ids, min(tags, len(tag_ids))):
+                        rows['transformationtotagmap'].append({ 'transformation': transformation_id, 'tag': tag_id })
+                    rows['log'].append({
+                        'date': revision_date,
+                        'body': f"user{author} {'edited' if revision else 'created'} a document.",
+                        'initiator': author,
+                        'affected_document': document_id,
+                        'visibility': 'public',
+                    })
+                first_comment = comment_id + 1
+                for _ in range(comments):
+                    comment_id += 1
+                    rows['comment'].append({
+                        'id': comment_id,
+                        'date': date + datetime.timedelta(seconds=revisions + comment_id - first_comment),
+                        'body': random_line(rng),
+                        'document': document_id,
+                        'user': rng.choice(user_ids),
+                        'parent': rng.randint(first_comment, comment_id - 1) if comment_id > first_comment and rng.random() < 0.5 else None,
+                    })
+                for user_id in rng.sample(user_ids, min(watches, len(user_ids))):
+                    rows['watch'].append({ 'user': user_id, 'document': document_id })
+            with server.write_transaction():
+                for model in (server.Document, server.Transformation, server.TransformationToTagMap, server.Comment, server.Watch, server.Log):
+                    for chunk in chunked(rows[model._meta.table_name], 100):
+                        model.insert_many(chunk).execute()
+            counts['revisions'] += len(rows['transformation'])
+            counts['comments'] += len(rows['comment'])
+            counts['watches'] += len(rows['watch'])
+        server.rebuild_document_heads()
+        server.rebuild_search_index()
+        server.rebuild_tag_stats()
+        server.rebuild_name_indexes()
+        # Leave a single file behind, so it can be copied as it is
+        server.database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    server.database.close_all()
+    counts['seconds'] = round(time.monotonic() - started, 1)
+    print(f'Generated {path}: {counts}')
+    return counts
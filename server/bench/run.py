@@ -0,0 +1,361 @@
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from waitress import serve
+import app as server
+from bench.generate import use_database, remove_database, words, password
+
+# SQL statements run by the app, counted across all threads
+statements = { 'count': 0 }
+statements_lock = threading.Lock()
+
+def count_statements():
+    execute_sql = server.database.execute_sql
+    def counted(sql, *args, **kwargs):
+        with statements_lock:
+            statements['count'] += 1
+        return execute_sql(sql, *args, **kwargs)
+    server.database.execute_sql = counted
+
+# Drivers send one request and return its status and the bytes on the wire
+class ClientDriver:
+    def __init__(self):
+        self.local = threading.local()
+
+    def request(self, method, url, headers=None, json=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = server.app.test_client()
+        response = self.local.client.open(url, method=method, headers=headers, json=json)
+        size = int(response.headers.get('Content-Length') or len(response.get_data()))
+        response.close()
+        return response.status_code, size
+
+class HTTPDriver:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method, url, headers=None, json=None):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        response = self.local.session.request(method, self.base_url + url, headers=headers, json=json)
+        return response.status_code, int(response.headers.get('Content-Length') or len(response.content))
+
+# Run serve() in a background thread on a free local port
+def start_server(threads):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    threading.Thread(target=serve, args=(server.app,), kwargs={ 'host': '127.0.0.1', 'port': port, 'threads': threads, '_quiet': True }, daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return f'http://127.0.0.1:{port}'
+
+def percentile(values, percent):
+    return values[max(0, min(len(values) - 1, int(len(values) * percent / 100 + 0.5) - 1))]
+
+# Send count requests built by make_request(i) from concurrency threads
+def measure(driver, make_request, count, concurrency, warmup):
+    for i in range(warmup):
+        driver.request(*make_request(-1 - i))
+    def timed(i):
+        method, url, headers, body = make_request(i)
+        started = time.perf_counter()
+        status, size = driver.request(method, url, headers, body)
+        return time.perf_counter() - started, status, size
+    with statements_lock:
+        before = statements['count']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, range(count)))
+    elapsed = time.perf_counter() - started
+    with statements_lock:
+        sql = statements['count'] - before
+    return summarize(results, elapsed, sql)
+
+# Latency, throughput and size figures for (latency, status, size) results
+# collected over elapsed seconds; sql is None when it can't be attributed
+def summarize(results, elapsed, sql):
+    count = len(results)
+    latencies = sorted(latency * 1000 for latency, status, size in results)
+    return {
+        'requests': count,
+        'errors': sum(1 for latency, status, size in results if status >= 400),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / count, 3),
+        'requests_per_second': round(count / elapsed, 1),
+        'sql_per_request': None if sql is None else round(sql / count, 2),
+        'bytes_per_request': round(sum(size for latency, status, size in results) / count),
+    }
+
+# Reads and writes at the same time: each request is a 'document put' with
+# probability write_share and otherwise one of the read scenarios, so writers
+# contend with readers for connections and the database lock. Requests are
+# built up front, so the worker threads only send them. Results are reported
+# per scenario plus 'mixed all' for the whole run.
+def measure_mixed(driver, makers, count, concurrency, warmup, write_share, rng):
+    reads = [name for name in makers if name not in write_scenarios and name != 'login']
+    names = [write_scenarios[0] if rng.random() < write_share else rng.choice(reads) for _ in range(warmup + count)]
+    planned = [(name, makers[name](i - warmup)) for i, name in enumerate(names)]
+    for name, request in planned[:warmup]:
+        driver.request(*request)
+    def timed(item):
+        name, (method, url, headers, body) = item
+        started = time.perf_counter()
+        status, size = driver.request(method, url, headers, body)
+        return name, (time.perf_counter() - started, status, size)
+    with statements_lock:
+        before = statements['count']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, planned[warmup:]))
+    elapsed = time.perf_counter() - started
+    with statements_lock:
+        sql = statements['count'] - before
+    by_name = {}
+    for name, result in results:
+        by_name.setdefault(name, []).append(result)
+    report = { f'mixed {name}': summarize(by_name[name], elapsed, None) for name in makers if name in by_name }
+    report['mixed all'] = summarize([result for name, result in results], elapsed, sql)
+    return report
+
+# Ids, hashes and names to build requests from, read from the benchmark database
+def sample_dataset(rng, size=500):
+    with server.database.connection_context():
+        uuids = [uuid for uuid, in server.Document.select(server.Document.uuid).order_by(server.Document.id).tuples()]
+        uuids = rng.sample(uuids, min(size, len(uuids)))
+        history = {}
+        for uuid, hash in (server.Transformation
+                .select(server.Document.uuid, server.Transformation.hash)
+                .join(server.Document)
+                .where(server.Document.uuid.in_(uuids[:100]))
+                .order_by(server.Transformation.id)
+                .tuples()):
+            history.setdefault(uuid, []).append(hash)
+        tags = [name for name, in server.Tag.select(server.Tag.name).order_by(server.Tag.id).tuples()]
+        tags = rng.sample(tags, min(size, len(tags)))
+        usernames = [name for name, in server.User.select(server.User.username).where(~server.User.is_admin).order_by(server.User.id).limit(size).tuples()]
+        counts = { model._meta.table_name: model.select().count() for model in (server.User, server.Document, server.Transformation, server.Tag, server.Comment, server.Watch, server.Log) }
+    return {
+        'uuids': uuids,
+        'history': [(uuid, hashes) for uuid, hashes in history.items() if len(hashes) > 1],
+        'tags': tags,
+        'usernames': usernames,
+        'counts': counts,
+    }
+
+def scenarios(data, token, rng):
+    auth = { 'Authorization': 'Bearer ' + token }
+    def get(url, headers=None):
+        return ('GET', url, headers, None)
+    def diff(i):
+        uuid, hashes = rng.choice(data['history'])
+        return get(f'/document/diff?uuid={uuid}&from={hashes[0]}&to={hashes[-1]}')
+    def revision(i):
+        uuid, hashes = rng.choice(data['history'])
+        return get(f'/document/revision?uuid={uuid}&hash={rng.choice(hashes)}')
+    def put(i):
+        body = '\n'.join(' '.join(rng.choice(words) for _ in range(10)) for _ in range(20))
+        return ('PUT', f"/document?uuid={rng.choice(data['uuids'])}", auth, { 'body': body, 'tags': rng.sample(data['tags'], 2) })
+    def login(i):
+        return ('POST', '/login', None, { 'username': rng.choice(data['usernames']), 'password': password })
+    return {
+        'document list': lambda i: get('/document?limit=20'),
+        'document list page 5': lambda i: get('/document?limit=20&page=5'),
+        'document search': lambda i: get(f'/document?query={rng.choice(words)}+{rng.choice(words)}'),
+        'document single': lambda i: get(f"/document?uuid={rng.choice(data['uuids'])}"),
+        'document history without bodies': lambda i: get(f"/document?uuid={rng.choice(data['uuids'])}&limit=10&bodies=false"),
+        'document revision': revision,
+        'document diff': diff,
+        'comments': lambda i: get(f"/comment?uuid={rng.choice(data['uuids'])}"),
+        'tag page': lambda i: get(f"/tag?slug={rng.choice(data['tags'])}"),
+        'tag cloud': lambda i: get('/tag'),
+        'tag suggest': lambda i: get(f'/tag/suggest?q={rng.choice(words)[:3]}'),
+        'user suggest': lambda i: get(f'/user/suggest?q=user{rng.randint(1, 9)}', auth),
+        'logs': lambda i: get('/log?limit=20', auth),
+        'document put': put,
+        'login': login,
+    }
+
+write_scenarios = ('document put',)
+
+# These request the same URL every time, so after the warm-up they only measure
+# response_cache hits. Run in-process, they are measured a second time with the
+# cache off, reported as '<name> uncached'.
+repeated_scenarios = ('document list', 'document list page 5', 'tag cloud')
+
+@contextmanager
+def response_cache_disabled():
+    size = server.response_cache.size
+    server.response_cache.size = 0
+    server.response_cache.clear()
+    try:
+        yield
+    finally:
+        server.response_cache.size = size
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Login attempts would soon hit the throttle, which is not what's measured
+def disable_throttle():
+    server.address_throttle = server.Throttle(1e9, 1e9)
+    server.username_throttle = server.Throttle(1e9, 1e9)
+
+# Benchmark the endpoints against a copy of the database at path, so write
+# scenarios leave the generated data untouched. With url, requests go to an
+# already running server (which should be using the same data) and SQL
+# statements aren't counted.
+def run(path, count=200, concurrency=1, warmup=10, http=False, url=None, only=None, seed=1, output=None, mixed=False, write_share=0.2):
+    rng = random.Random(seed)
+    copy = None
+    if url is None:
+        copy = os.path.join(tempfile.mkdtemp(prefix='gosshub-bench-'), 'bench.db')
+        source, target = sqlite3.connect(path), sqlite3.connect(copy)
+        source.backup(target)
+        source.close()
+        target.close()
+        use_database(copy)
+        # Databases generated by older commits get any newer tables
+        server.create_tables()
+        count_statements()
+        disable_throttle()
+    else:
+        use_database(path)
+    data = sample_dataset(rng)
+    if url is None and http:
+        url = start_server(max(4, concurrency))
+    driver = HTTPDriver(url) if url else ClientDriver()
+    token = login_token(url, data['usernames'][0])
+    makers = { name: make_request for name, make_request in scenarios(data, token, rng).items()
+            if not only or any(part in name for part in only) or (mixed and name in write_scenarios) }
+    results = {}
+    if mixed:
+        results = measure_mixed(driver, makers, count, concurrency, warmup, write_share, rng)
+        for name, result in results.items():
+            print_result(name, result)
+        makers = {}
+    for name, make_request in makers.items():
+        results[name] = measure(driver, make_request, count, concurrency, warmup)
+        print_result(name, results[name])
+        if copy and name in repeated_scenarios:
+            with response_cache_disabled():
+                results[name + ' uncached'] = measure(driver, make_request, count, concurrency, warmup)
+            print_result(name + ' uncached', results[name + ' uncached'])
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'mode': 'http' if url else 'client',
+            'requests': count,
+            'concurrency': concurrency,
+            'mixed': mixed,
+            'write_share': write_share if mixed else None,
+            'seed': seed,
+            'dataset': data['counts'],
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'results': results,
+    }
+    write_report(report, output)
+    if copy:
+        # Buffered log entries belong to the copy about to be removed
+        server.log_buffer.flush()
+        server.database.close_all()
+        remove_database(copy)
+        os.rmdir(os.path.dirname(copy))
+    return report
+
+def login_token(url, username):
+    if url:
+        response = requests.post(url.rstrip('/') + '/login', json={ 'username': username, 'password': password })
+        status, data = response.status_code, response.json()
+    else:
+        response = server.app.test_client().post('/login', json={ 'username': username, 'password': password })
+        status, data = response.status_code, response.get_json()
+    if status != 200:
+        raise SystemExit(f'Could not log in as {username}: {data}')
+    return data['token']
+
+def write_report(report, output):
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+def print_result(name, result):
+    print(f"{name:34} p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+          f"{result['requests_per_second']:8.1f} req/s  {'-' if result['sql_per_request'] is None else format(result['sql_per_request'], '.2f'):>6} sql  {result['bytes_per_request']:8d} B"
+          + (f"  {result['errors']} errors" if result['errors'] else ''))
+
+# Compare serving frontend assets the old way (original names, no compression)
+# with the content-hashed, precompressed files from build_static_assets()
+def static(count=200, concurrency=1, http=False, output=None):
+    manifest = server.load_static_manifest()
+    if not manifest:
+        raise SystemExit('No dist/manifest.json: run build_static_assets() first.')
+    driver = HTTPDriver(start_server(max(4, concurrency))) if http else ClientDriver()
+    compressed = { 'Accept-Encoding': 'br, gzip' }
+    results = {}
+    for name in ('bundle.js', 'main.css', 'font-awesome.min.css', 'webfonts/fa-solid-900.woff2', 'webfonts/fa-solid-900.ttf'):
+        if name not in manifest:
+            continue
+        for label, url, headers in (('original', f'/cdn/{name}', None), ('hashed', f"/cdn/{manifest[name]['path']}", compressed)):
+            results[f'{name} {label}'] = measure(driver, lambda i, url=url, headers=headers: ('GET', url, headers, None), count, concurrency, 5)
+            print_result(f'{name} {label}', results[f'{name} {label}'])
+    etag = server.get_spa_shell()[1]
+    results['index.html'] = measure(driver, lambda i: ('GET', '/', None, None), count, concurrency, 5)
+    results['index.html revalidated'] = measure(driver, lambda i: ('GET', '/', { 'If-None-Match': f'"{etag}"' }, None), count, concurrency, 5)
+    for name in ('index.html', 'index.html revalidated'):
+        print_result(name, results[name])
+    report = { 'meta': { 'commit': git_commit(), 'mode': 'http' if http else 'client', 'requests': count, 'concurrency': concurrency }, 'results': results }
+    write_report(report, output)
+    return report
+
+# Time export_data() of the benchmark database and import_data() of the
+# export into an empty database
+def transfer(path, output=None):
+    folder = tempfile.mkdtemp(prefix='gosshub-bench-')
+    export_path = os.path.join(folder, 'export.ndjson.gz')
+    use_database(path)
+    started = time.monotonic()
+    rows = sum(server.export_data(export_path).values())
+    export_seconds = time.monotonic() - started
+    use_database(os.path.join(folder, 'import.db'))
+    started = time.monotonic()
+    server.import_data(export_path)
+    import_seconds = time.monotonic() - started
+    server.database.close_all()
+    remove_database(os.path.join(folder, 'import.db'))
+    report = {
+        'meta': { 'commit': git_commit(), 'rows': rows },
+        'results': {
+            'export': { 'seconds': round(export_seconds, 2), 'rows_per_second': round(rows / export_seconds) },
+            'import': { 'seconds': round(import_seconds, 2), 'rows_per_second': round(rows / import_seconds) },
+        },
+    }
+    os.remove(export_path)
+    os.rmdir(folder)
+    write_report(report, output)
+    return report
@@ -0,0 +1,44 @@
+# The app reads config.toml from the server folder on import; each test gets
+# its own SQLite database and empty caches on top of those settings.
+import datetime
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as server
+
+@pytest.fixture
+def client(tmp_path):
+    server.database.close_all()
+    server.database.init(str(tmp_path / 'test.db'))
+    server.database.replica = None
+    server.app.config.update(
+        PASSWORD_WORKERS=0,
+        LOG_BUFFER=False,
+        EMAIL_TRANSPORT='file',
+        EMAIL_FILE=str(tmp_path / 'outbox.ndjson'),
+        NOTIFICATION_DIGEST_WINDOW=0)
+    for cache in (server.response_cache, server.user_cache, server.tag_cache, server.body_cache, server.diff_cache,
+            server.address_throttle.buckets, server.username_throttle.buckets):
+        cache.clear()
+    server.create_tables()
+    yield server.app.test_client()
+    server.database.close_all()
+
+# Create a verified user and return the headers of a logged in request
+@pytest.fixture
+def login(client):
+    def login(username, is_admin=False):
+        with server.database.connection_context():
+            server.User.create(
+                username=username,
+                password=server.hash_password_job('secret1', server.password_rounds),
+                email=f'{username}@example.com',
+                join_date=datetime.datetime.now(),
+                is_admin=is_admin,
+                is_verified=True)
+        response = client.post('/login', json={ 'username': username, 'password': 'secret1' })
+        assert response.status_code == 200, response.get_json()
+        return { 'Authorization': 'Bearer ' + response.get_json()['token'] }
+    return login
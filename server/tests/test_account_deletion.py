@@ -0,0 +1,44 @@
+import jwt
+import app as server
+
+def edit_and_comment(client, alice, bob):
+    assert client.post('/document', json={ 'body': 'first', 'tags': ['cats'] }, headers=alice).status_code == 200
+    uuid = client.get('/document').get_json()[0]['uuid']
+    assert client.put(f'/document?uuid={uuid}', json={ 'body': 'second', 'tags': ['dogs'] }, headers=bob).status_code == 200
+    assert client.post('/comment', json={ 'uuid': uuid, 'body': 'nice' }, headers=bob).status_code == 200
+    with server.database.connection_context():
+        bob_id = server.User.get(server.User.username == 'bob').id
+    return uuid, bob_id
+
+def assert_released(client, uuid, bob_id):
+    with server.database.connection_context():
+        transformations = list(server.Transformation.select().order_by(server.Transformation.id))
+        assert [t.user_id is None for t in transformations] == [False, True]
+        assert [c.user_id for c in server.Comment.select()] == [None]
+        assert server.Tag.get(server.Tag.name == 'dogs').creator_id is None
+        assert not server.Log.select().where((server.Log.initiator == bob_id) | (server.Log.affected_user == bob_id)).exists()
+        assert not server.User.select().where(server.User.id == bob_id).exists()
+    documents = client.get('/document').get_json()
+    assert [d['uuid'] for d in documents] == [uuid]
+    document = client.get(f'/document?uuid={uuid}').get_json()
+    assert document['transformations'][0]['body'] == 'second'
+
+def test_deleted_author_rows_survive(client, login):
+    alice, bob = login('alice'), login('bob')
+    uuid, bob_id = edit_and_comment(client, alice, bob)
+    assert client.delete('/user', headers=bob).status_code == 200
+    assert_released(client, uuid, bob_id)
+
+def test_background_deletion(client, login):
+    alice, bob = login('alice'), login('bob')
+    uuid, bob_id = edit_and_comment(client, alice, bob)
+    server.app.config['USER_DELETE_BATCH_SIZE'] = 1
+    assert client.delete('/user?background=true', headers=bob).status_code == 202
+    # The disabled account can't be verified again while the deletion runs
+    assert client.post('/reset-token', json={ 'email': 'bob@example.com' }).status_code == 400
+    token = jwt.encode({ 'username': 'bob' }, server.app.config['SECRET_KEY'], algorithm='HS256')
+    with server.database.connection_context():
+        server.User.update(verification_token=token).where(server.User.id == bob_id).execute()
+    assert client.post('/verify-email', json={ 'verification_token': token }).status_code == 400
+    server.run_background_tasks()
+    assert_released(client, uuid, bob_id)
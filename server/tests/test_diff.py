@@ -0,0 +1,7 @@
+import app as server
+
+def test_word_diff_keeps_whitespace_apart():
+    hunks = server.diff_hunks('line1\nline2\nline3', 'line1\nline2\nline3\nmore words\n', 'word', 1)
+    assert hunks[0]['changes'] == [['=', 'line2\nline3'], ['+', '\nmore words\n']]
+    hunks = server.diff_hunks('the quick brown fox\n', 'the quick red fox\n', 'word', 0)
+    assert hunks[0]['changes'] == [['=', 'the quick '], ['-', 'brown'], ['+', 'red'], ['=', ' fox\n']]
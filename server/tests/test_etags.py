@@ -0,0 +1,41 @@
+import app as server
+
+def etag(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return response.headers['ETag']
+
+def test_rename_changes_listing_etags(client, login):
+    alice = login('alice')
+    assert client.post('/document', json={ 'body': 'hello', 'tags': ['cats'] }, headers=alice).status_code == 200
+    uuid = client.get('/document').get_json()[0]['uuid']
+    urls = ['/document', f'/document?uuid={uuid}', '/tag?slug=cats', f'/comment?uuid={uuid}']
+    before = [etag(client, url) for url in urls]
+    assert client.put('/user', json={ 'username': 'alicia' }, headers=alice).status_code == 200
+    for url, old in zip(urls, before):
+        response = client.get(url, headers={ 'If-None-Match': old })
+        assert response.status_code == 200, url
+    assert client.get('/document').get_json()[0]['transformations'][0]['username'] == 'alicia'
+
+def test_recreated_page_etag(client, login):
+    alice = login('alice', is_admin=True)
+    page = { 'slug': 'about', 'title': 'About', 'body': 'old' }
+    assert client.post('/page', json=page, headers=alice).status_code == 200
+    old = etag(client, '/page?slug=about')
+    assert client.delete('/page?slug=about', headers=alice).status_code == 200
+    assert client.post('/page', json=dict(page, body='new'), headers=alice).status_code == 200
+    response = client.get('/page?slug=about', headers={ 'If-None-Match': old })
+    assert response.status_code == 200
+    assert response.get_json()['body'] == 'new'
+
+def test_rebuilt_heads_etag(client, login):
+    alice = login('alice')
+    assert client.post('/document', json={ 'body': 'hello' }, headers=alice).status_code == 200
+    uuid = client.get('/document').get_json()[0]['uuid']
+    old = etag(client, f'/document?uuid={uuid}')
+    assert client.post('/comment', json={ 'uuid': uuid, 'body': 'nice' }, headers=alice).status_code == 200
+    with server.database.connection_context():
+        server.rebuild_document_heads()
+    response = client.get(f'/document?uuid={uuid}', headers={ 'If-None-Match': old })
+    assert response.status_code == 200
+    assert len(response.get_json()['comments']) == 1
@@ -0,0 +1,36 @@
+import datetime
+import pytest
+import app as server
+
+def entry(body, initiator=None):
+    return { 'date': datetime.datetime.now(), 'body': body, 'initiator': initiator, 'affected_user': None, 'affected_document': None, 'visibility': 'admin' }
+
+def log_bodies():
+    with server.database.connection_context():
+        return [row.body for row in server.Log.select().where(server.Log.body.startswith('buffered')).order_by(server.Log.id)]
+
+def test_failed_flush_keeps_entries(client, monkeypatch):
+    buffer = server.LogBuffer()
+    buffer.entries = [entry('buffered 1'), entry('buffered 2')]
+    insert_many = server.Log.insert_many
+    def locked(rows):
+        raise server.OperationalError('database is locked')
+    monkeypatch.setattr(server.Log, 'insert_many', locked)
+    with pytest.raises(server.OperationalError):
+        buffer.flush()
+    assert [e['body'] for e in buffer.entries] == ['buffered 1', 'buffered 2']
+    monkeypatch.setattr(server.Log, 'insert_many', insert_many)
+    buffer.flush()
+    assert buffer.entries == []
+    assert log_bodies() == ['buffered 1', 'buffered 2']
+
+def test_entries_of_deleted_user(client, login):
+    login('bob')
+    with server.database.connection_context():
+        bob = server.User.get(server.User.username == 'bob')
+        buffer = server.LogBuffer()
+        buffer.entries = [entry('buffered by bob', bob)]
+        server.delete_user(bob.id)
+    buffer.flush()
+    with server.database.connection_context():
+        assert server.Log.get(server.Log.body == 'buffered by bob').initiator_id is None
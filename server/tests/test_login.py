@@ -0,0 +1,6 @@
+import app as server
+
+def test_login_rejects_non_string_username(client):
+    response = client.post('/login', json={ 'username': 5, 'password': 'secret1' })
+    assert response.status_code == 400
+    assert server.address_throttle.buckets.stats()['size'] == 0
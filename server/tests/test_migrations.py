@@ -0,0 +1,60 @@
+import sqlite3
+import app as server
+
+# The schema created by the first release, before any migration existed
+baseline_schema = '''
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "username" VARCHAR(255) NOT NULL, "password" VARCHAR(255) NOT NULL, "email" VARCHAR(255) NOT NULL, "join_date" DATETIME NOT NULL, "is_admin" INTEGER NOT NULL, "is_verified" INTEGER NOT NULL, "verification_token" VARCHAR(255));
+CREATE UNIQUE INDEX "user_username" ON "user" ("username");
+CREATE UNIQUE INDEX "user_email" ON "user" ("email");
+CREATE TABLE "document" ("id" INTEGER NOT NULL PRIMARY KEY, "created_date" DATETIME NOT NULL, "archived" INTEGER NOT NULL, "uuid" VARCHAR(255) NOT NULL);
+CREATE UNIQUE INDEX "document_uuid" ON "document" ("uuid");
+CREATE TABLE "tag" ("id" INTEGER NOT NULL PRIMARY KEY, "created_date" DATETIME NOT NULL, "creator_id" INTEGER, "name" VARCHAR(255) NOT NULL, "description" TEXT, FOREIGN KEY ("creator_id") REFERENCES "user" ("id"));
+CREATE INDEX "tag_creator_id" ON "tag" ("creator_id");
+CREATE UNIQUE INDEX "tag_name" ON "tag" ("name");
+CREATE TABLE "transformation" ("id" INTEGER NOT NULL PRIMARY KEY, "hash" VARCHAR(255) NOT NULL, "date" DATETIME NOT NULL, "document_id" INTEGER NOT NULL, "user_id" INTEGER, "body" TEXT NOT NULL, "comment" TEXT, FOREIGN KEY ("document_id") REFERENCES "document" ("id"), FOREIGN KEY ("user_id") REFERENCES "user" ("id"));
+CREATE UNIQUE INDEX "transformation_hash" ON "transformation" ("hash");
+CREATE INDEX "transformation_document_id" ON "transformation" ("document_id");
+CREATE INDEX "transformation_user_id" ON "transformation" ("user_id");
+CREATE TABLE "watch" ("id" INTEGER NOT NULL PRIMARY KEY, "document_id" INTEGER NOT NULL, "user_id" INTEGER NOT NULL, FOREIGN KEY ("document_id") REFERENCES "document" ("id"), FOREIGN KEY ("user_id") REFERENCES "user" ("id"));
+CREATE INDEX "watch_document_id" ON "watch" ("document_id");
+CREATE INDEX "watch_user_id" ON "watch" ("user_id");
+CREATE TABLE "transformationtotagmap" ("id" INTEGER NOT NULL PRIMARY KEY, "transformation_id" INTEGER NOT NULL, "tag_id" INTEGER NOT NULL, FOREIGN KEY ("transformation_id") REFERENCES "transformation" ("id"), FOREIGN KEY ("tag_id") REFERENCES "tag" ("id"));
+CREATE INDEX "transformationtotagmap_transformation_id" ON "transformationtotagmap" ("transformation_id");
+CREATE INDEX "transformationtotagmap_tag_id" ON "transformationtotagmap" ("tag_id");
+CREATE TABLE "log" ("id" INTEGER NOT NULL PRIMARY KEY, "date" DATETIME NOT NULL, "body" VARCHAR(255) NOT NULL, "initiator_id" INTEGER, "affected_user_id" INTEGER, "affected_document_id" INTEGER, "visibility" VARCHAR(255) NOT NULL, FOREIGN KEY ("initiator_id") REFERENCES "user" ("id"), FOREIGN KEY ("affected_user_id") REFERENCES "user" ("id"), FOREIGN KEY ("affected_document_id") REFERENCES "document" ("id"));
+CREATE INDEX "log_initiator_id" ON "log" ("initiator_id");
+CREATE INDEX "log_affected_user_id" ON "log" ("affected_user_id");
+CREATE INDEX "log_affected_document_id" ON "log" ("affected_document_id");
+CREATE TABLE "page" ("id" INTEGER NOT NULL PRIMARY KEY, "slug" VARCHAR(255) NOT NULL, "title" TEXT NOT NULL, "body" TEXT NOT NULL);
+CREATE UNIQUE INDEX "page_slug" ON "page" ("slug");
+CREATE TABLE "comment" ("id" INTEGER NOT NULL PRIMARY KEY, "date" DATETIME NOT NULL, "body" VARCHAR(255) NOT NULL, "document_id" INTEGER NOT NULL, "user_id" INTEGER, "parent_id" INTEGER, FOREIGN KEY ("document_id") REFERENCES "document" ("id"), FOREIGN KEY ("user_id") REFERENCES "user" ("id"), FOREIGN KEY ("parent_id") REFERENCES "comment" ("id"));
+CREATE INDEX "comment_document_id" ON "comment" ("document_id");
+CREATE INDEX "comment_user_id" ON "comment" ("user_id");
+CREATE INDEX "comment_parent_id" ON "comment" ("parent_id");
+INSERT INTO "user" VALUES (1, 'alice', 'x', 'alice@example.com', '2024-01-01 00:00:00', 0, 1, NULL);
+INSERT INTO "document" VALUES (1, '2024-01-01 00:00:00', 0, 'doc1');
+INSERT INTO "tag" VALUES (1, '2024-01-01 00:00:00', 1, 'cats', NULL);
+INSERT INTO "transformation" VALUES (1, 'h1', '2024-01-01 00:00:00', 1, 1, 'first', NULL);
+INSERT INTO "transformation" VALUES (2, 'h2', '2024-01-02 00:00:00', 1, 1, 'second', NULL);
+INSERT INTO "transformationtotagmap" VALUES (1, 2, 1);
+INSERT INTO "watch" VALUES (1, 1, 1);
+INSERT INTO "watch" VALUES (2, 1, 1);
+'''
+
+def test_hot_queries_on_fresh_database(client):
+    assert server.explain_hot_queries()
+
+def test_hot_queries_on_migrated_database(client, tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    connection = sqlite3.connect(path)
+    connection.executescript(baseline_schema)
+    connection.close()
+    server.database.close_all()
+    server.database.init(path)
+    server.create_tables()
+    assert server.explain_hot_queries()
+    with server.database.connection_context():
+        assert max(version for version, migration in server.migrations) == server.SchemaVersion.select(server.fn.MAX(server.SchemaVersion.version)).scalar()
+        assert server.Watch.select().count() == 1
+    documents = client.get('/tag?slug=cats').get_json()
+    assert [d['transformations'][0]['body'] for d in documents] == ['second']
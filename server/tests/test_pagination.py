@@ -0,0 +1,11 @@
+def test_tag_page_whole_unless_paginated(client, login):
+    alice = login('alice')
+    for i in range(25):
+        assert client.post('/document', json={ 'body': f'cat {i}', 'tags': ['cats'] }, headers=alice).status_code == 200
+    response = client.get('/tag?slug=cats')
+    assert len(response.get_json()) == 25
+    assert 'X-Next-Cursor' not in response.headers
+    first = client.get('/tag?slug=cats&limit=20')
+    assert len(first.get_json()) == 20
+    rest = client.get('/tag?slug=cats&limit=20&cursor=' + first.headers['X-Next-Cursor']).get_json()
+    assert [d['uuid'] for d in first.get_json() + rest] == [d['uuid'] for d in response.get_json()]
@@ -0,0 +1,36 @@
+import app as server
+
+def count_queries(client, monkeypatch, url):
+    server.response_cache.clear()
+    count = 0
+    execute_sql = server.database.execute_sql
+    def counted(sql, *args, **kwargs):
+        nonlocal count
+        count += 1
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(server.database, 'execute_sql', counted)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        monkeypatch.setattr(server.database, 'execute_sql', execute_sql)
+    return count
+
+def add_documents(client, headers, count, first=0):
+    for i in range(first, first + count):
+        assert client.post('/document', json={ 'body': f'document {i}', 'tags': ['cats', f'tag{i}'] }, headers=headers).status_code == 200
+        uuid = client.get('/document?limit=1').get_json()[0]['uuid']
+        assert client.put(f'/document?uuid={uuid}', json={ 'body': f'document {i} edited', 'tags': ['cats', 'dogs'] }, headers=headers).status_code == 200
+        assert client.post('/comment', json={ 'uuid': uuid, 'body': 'nice' }, headers=headers).status_code == 200
+    return uuid
+
+def test_query_counts_stay_flat(client, login, monkeypatch):
+    alice = login('alice')
+    uuid = add_documents(client, alice, 2)
+    urls = ['/document', '/tag?slug=cats', f'/document?uuid={uuid}']
+    before = [count_queries(client, monkeypatch, url) for url in urls]
+    uuid = add_documents(client, alice, 10, first=2)
+    for i in range(5):
+        assert client.put(f'/document?uuid={uuid}', json={ 'body': f'edit {i}', 'tags': ['cats'] }, headers=alice).status_code == 200
+    urls[2] = f'/document?uuid={uuid}'
+    after = [count_queries(client, monkeypatch, url) for url in urls]
+    assert before == after
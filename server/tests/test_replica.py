@@ -0,0 +1,30 @@
+import sqlite3
+import app as server
+
+def test_reads_use_replica_and_writes_primary(client, login, tmp_path, monkeypatch):
+    alice = login('alice')
+    assert client.post('/document', json={ 'body': 'primary body' }, headers=alice).status_code == 200
+    uuid = client.get('/document').get_json()[0]['uuid']
+    # A file copy of the primary stands in for the replica, then drifts from it
+    path = str(tmp_path / 'replica.db')
+    source, target = sqlite3.connect(server.database.database), sqlite3.connect(path)
+    source.backup(target)
+    target.execute("UPDATE transformation SET body = 'replica body'")
+    target.commit()
+    source.close()
+    target.close()
+    replica = server.connect_database(path, {})
+    monkeypatch.setattr(server.database, 'replica', replica)
+    try:
+        for cache in (server.response_cache, server.body_cache):
+            cache.clear()
+        document = client.get(f'/document?uuid={uuid}').get_json()
+        assert document['transformations'][0]['body'] == 'replica body'
+        assert client.put(f'/document?uuid={uuid}', json={ 'body': 'edited' }, headers=alice).status_code == 200
+        with server.database.connection_context():
+            bodies = [t.body for t in server.Transformation.select().order_by(server.Transformation.id)]
+        assert bodies == ['primary body', 'edited']
+        with replica.connection_context():
+            assert replica.execute_sql('SELECT COUNT(*) FROM transformation').fetchone()[0] == 1
+    finally:
+        replica.close_all()
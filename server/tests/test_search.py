@@ -0,0 +1,7 @@
+def test_snippet_is_escaped(client, login):
+    alice = login('alice')
+    body = 'cats <img src=x onerror=alert(1)> & dogs'
+    assert client.post('/document', json={ 'body': body }, headers=alice).status_code == 200
+    results = client.get('/document?query=cats').get_json()
+    snippet = results[0]['transformations'][0]['snippet']
+    assert snippet == '<mark>cats</mark> &lt;img src=x onerror=alert(1)&gt; &amp; dogs'
@@ -0,0 +1,16 @@
+import gzip
+import app as server
+
+def test_precompressed_variant_honours_q_values(client, tmp_path, monkeypatch):
+    name = 'app.0123456789ab.js'
+    (tmp_path / name).write_text('var a = 1;')
+    (tmp_path / (name + '.gz')).write_bytes(gzip.compress(b'var a = 1;'))
+    monkeypatch.setattr(server, 'static_dist', str(tmp_path))
+    monkeypatch.setitem(server.static_assets, name, ['gzip'])
+    response = client.get('/cdn/' + name, headers={ 'Accept-Encoding': 'gzip, br' })
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    for accept in ('gzip;q=0', 'identity', None):
+        headers = { 'Accept-Encoding': accept } if accept else {}
+        response = client.get('/cdn/' + name, headers=headers)
+        assert 'Content-Encoding' not in response.headers, accept
+        assert response.get_data() == b'var a = 1;'
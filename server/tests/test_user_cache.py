@@ -0,0 +1,14 @@
+import app as server
+
+def test_reset_token_survives_cached_user_edit(client, login):
+    alice = login('alice')
+    # Puts alice in user_cache
+    assert client.get('/user', headers=alice).status_code == 200
+    assert client.post('/reset-password', json={ 'email': 'alice@example.com' }).status_code == 200
+    assert client.put('/user', json={ 'username': 'alicia' }, headers=alice).status_code == 200
+    with server.database.connection_context():
+        token = server.User.get(server.User.username == 'alicia').verification_token
+    assert token
+    response = client.post('/new-password', json={ 'password': 'secret2', 'repeat_password': 'secret2', 'verification_token': token })
+    assert response.status_code == 200
+    assert client.post('/login', json={ 'username': 'alicia', 'password': 'secret2' }).status_code == 200